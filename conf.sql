@@ -0,0 +1,67 @@
+-- davitrans configuration database schema
+-- sqlite3 conf.db < conf.sql
+CREATE TABLE cxdef (id INT UNIQUE PRIMARY KEY, cxname VARCHAR UNIQUE);
+CREATE TABLE tx (id INT UNIQUE PRIMARY KEY, name VARCHAR UNIQUE NOT NULL, sourcedir VARCHAR NOT NULL UNIQUE, cxid INT NOT NULL, targetdir VARCHAR NOT NULL, archivedir VARCHAR, sftp INT NOT NULL DEFAULT 0,
+  priority INT NOT NULL DEFAULT 0,    -- lower values are sent first
+  checksum VARCHAR,                   -- md5, sha1, sha224, sha256, sha384 or sha512: stream and verify each file (ssh, fanout, delta append or local transports)
+  dedup VARCHAR,                      -- skip, link or copy files whose content was already delivered
+  dedupwindow INT,                    -- seconds a delivered content is remembered, --dedup-window if NULL
+  bundle INT NOT NULL DEFAULT 0,      -- 1: send the cycle's files as one tar stream
+  include VARCHAR,                    -- comma separated globs ('re:' for regular expressions) to transfer
+  exclude VARCHAR,                    -- comma separated globs ('re:' for regular expressions) to skip
+  minsize INT,                        -- bytes
+  maxsize INT,                        -- bytes
+  minage INT,                         -- seconds since last modified (first listed for sftp rx rows)
+  transport VARCHAR,                  -- scp, sftp, ssh, bundle, fanout, delta or local; NULL: from fanout, delta, bundle, compress, checksum and sftp
+  compress VARCHAR,                   -- gzip or zstd: compress while streaming (ssh and fanout transports)
+  level INT,                          -- compression level, the codec default if NULL
+  suffix VARCHAR,                     -- added to remote names, .gz or .zst if NULL
+  fanout VARCHAR,                     -- comma separated cxname or cxname:targetdir also delivered to, reading each file once
+  quorum INT,                         -- targets (own connection included) that must have a file to archive it, all if NULL; the rest are sent the archived copy
+  delta VARCHAR,                      -- append: send only what was appended to the remote copy; rsync: changed blocks
+  window VARCHAR,                     -- cron-like 'min hour dom mon dow' when the row is sent, several separated by ';'
+  batchfiles INT,                     -- send once this many files wait,
+  batchmb INT,                        --   or this many MB,
+  batchdelay INT,                     --   or one waited this many seconds; NULL: no batching
+  quarantinedir VARCHAR               -- files failing --retry-max times are moved here, --quarantine if NULL
+);
+CREATE TABLE rx (id INT UNIQUE PRIMARY KEY, name VARCHAR UNIQUE NOT NULL, sourcedir VARCHAR NOT NULL UNIQUE, cxid INT NOT NULL, targetdir VARCHAR NOT NULL, sftp INT NOT NULL DEFAULT 0,
+  priority INT NOT NULL DEFAULT 0,    -- lower values are received first
+  checksum VARCHAR,                   -- md5, sha1, sha224, sha256, sha384 or sha512: stream and verify each file
+  bundle INT NOT NULL DEFAULT 0,      -- 1: receive the cycle's files as tar streams
+  include VARCHAR,                    -- comma separated globs ('re:' for regular expressions) to transfer
+  exclude VARCHAR,                    -- comma separated globs ('re:' for regular expressions) to skip
+  minsize INT,                        -- bytes
+  maxsize INT,                        -- bytes
+  minage INT,                         -- seconds since last modified (first listed for sftp rx rows)
+  transport VARCHAR,                  -- scp, sftp, ssh, bundle or local; NULL: from bundle, compress, checksum and sftp
+  compress VARCHAR,                   -- gzip or zstd: decompress while streaming (ssh transport)
+  suffix VARCHAR,                     -- removed from local names, .gz or .zst if NULL
+  window VARCHAR,                     -- cron-like 'min hour dom mon dow' when the row is received, several separated by ';'
+  batchfiles INT,                     -- receive once this many files wait,
+  batchmb INT,                        --   or this many MB,
+  batchdelay INT,                     --   or one waited this many seconds (since first listed); NULL: no batching
+  durable INT NOT NULL DEFAULT 0      -- 1: sync received files to disk in groups (--sync-group) before removing the remote copies
+);
+
+-- State tables, created by davitrans when needed
+CREATE TABLE IF NOT EXISTS checksums (ts VARCHAR NOT NULL, cxname VARCHAR NOT NULL, direction VARCHAR NOT NULL,
+  name VARCHAR NOT NULL, path VARCHAR NOT NULL, size INT, algorithm VARCHAR, localsum VARCHAR, remotesum VARCHAR, ok INT);
+CREATE INDEX IF NOT EXISTS checksums_ts ON checksums (ts);
+CREATE TABLE IF NOT EXISTS delivered (cxname VARCHAR NOT NULL, targetdir VARCHAR NOT NULL, size INT NOT NULL,
+  hash VARCHAR, archived VARCHAR, remote VARCHAR NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS delivered_size ON delivered (cxname, targetdir, size);
+CREATE INDEX IF NOT EXISTS delivered_ts ON delivered (cxname, targetdir, ts);
+CREATE TABLE IF NOT EXISTS fanout (cxname VARCHAR NOT NULL, targetdir VARCHAR NOT NULL, path VARCHAR NOT NULL,
+  version VARCHAR NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS fanout_path ON fanout (path);
+CREATE TABLE IF NOT EXISTS fanout_owed (name VARCHAR NOT NULL, cxname VARCHAR NOT NULL, targetdir VARCHAR NOT NULL,
+  archived VARCHAR NOT NULL, attempts INT NOT NULL, nextat REAL NOT NULL, ts REAL NOT NULL,
+  PRIMARY KEY (cxname, targetdir, archived));
+CREATE TABLE IF NOT EXISTS retries (cxname VARCHAR NOT NULL, direction VARCHAR NOT NULL, name VARCHAR NOT NULL,
+  path VARCHAR NOT NULL, attempts INT NOT NULL, nextat REAL NOT NULL, lastrc INT, status VARCHAR NOT NULL, ts REAL NOT NULL,
+  PRIMARY KEY (cxname, direction, path));
+CREATE TABLE IF NOT EXISTS archives (source VARCHAR PRIMARY KEY, target VARCHAR NOT NULL, name VARCHAR NOT NULL, ts REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS throughput (cxname VARCHAR NOT NULL, direction VARCHAR NOT NULL, name VARCHAR NOT NULL,
+  files INT NOT NULL, bytes INT NOT NULL, seconds REAL NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS throughput_cx ON throughput (cxname, direction);
@@ -10,69 +10,311 @@ Created by Ramón Barrios Láscar, 2025-02-21
 from datetime import datetime
 from optparse import OptionParser, SUPPRESS_HELP
 from time import sleep
+import atexit
+import collections
+import cProfile
+import ctypes
+import errno
+import fcntl
+import fnmatch
+import hashlib
 import logging, logging.handlers
 import os
+import queue
+import re
+import shlex
+import signal
 import sqlite3
 import string
 import subprocess
 import sys
+import socket
+import tarfile
 import tempfile
+import threading
+import time
+import urllib.parse
 
-def load_all_conf(dbfilename: str) -> ():
+# Columns loaded for each tx/rx row as (name, default). The first ones keep
+# their historical positions (tx[0]..tx[3], rx[0]..rx[2]); columns missing in
+# older configuration databases are loaded with their default
+TX_COLUMNS = [ ("sourcedir", None), ("targetdir", None), ("archivedir", None), ("sftp", None),
+               ("id", None), ("name", None), ("priority", "0"), ("checksum", "NULL"),
+               ("dedup", "NULL"), ("dedupwindow", "NULL"), ("bundle", "0"),
+               ("include", "NULL"), ("exclude", "NULL"), ("minsize", "NULL"), ("maxsize", "NULL"), ("minage", "NULL"),
+               ("transport", "NULL"), ("compress", "NULL"), ("level", "NULL"), ("suffix", "NULL"),
+               ("fanout", "NULL"), ("quorum", "NULL"), ("delta", "NULL"),
+               ("window", "NULL"), ("batchfiles", "NULL"), ("batchmb", "NULL"), ("batchdelay", "NULL"),
+               ("quarantinedir", "NULL"), ]
+RX_COLUMNS = [ ("sourcedir", None), ("targetdir", None), ("sftp", None),
+               ("id", None), ("name", None), ("priority", "0"), ("checksum", "NULL"),
+               ("bundle", "0"),
+               ("include", "NULL"), ("exclude", "NULL"), ("minsize", "NULL"), ("maxsize", "NULL"), ("minage", "NULL"),
+               ("transport", "NULL"), ("compress", "NULL"), ("suffix", "NULL"),
+               ("window", "NULL"), ("batchfiles", "NULL"), ("batchmb", "NULL"), ("batchdelay", "NULL"),
+               ("durable", "0"), ]
+
+# Compressors tx/rx rows can stream their files through, with the suffix
+# compressed files get and the option naming their binary
+CODECS = {
+  "gzip": { "suffix": ".gz", "bin": "gzip", },
+  "zstd": { "suffix": ".zst", "bin": "zstd", },
+}
+
+# Checksums rows can verify with, the ones the default --hash-cmd (md5sum,
+# sha1sum...) hashes remotely too
+CHECKSUMS = [ "md5", "sha1", "sha224", "sha256", "sha384", "sha512", ]
+
+# Phases the time of each cycle is split in, and the upper bounds in seconds
+# of the buckets their rolling histograms count
+PHASES = [ "scan", "listing", "transfer", "archive", "sleep", ]
+HISTOGRAM = [ 0.01, 0.1, 1, 10, 100, ]
+
+# Return code of transport functions that queued the work for their flush
+QUEUED = -1
+
+# State tables davitrans keeps in the configuration database
+STATE_SQL = """
+CREATE TABLE IF NOT EXISTS checksums (ts VARCHAR NOT NULL, cxname VARCHAR NOT NULL, direction VARCHAR NOT NULL,
+  name VARCHAR NOT NULL, path VARCHAR NOT NULL, size INT, algorithm VARCHAR, localsum VARCHAR, remotesum VARCHAR, ok INT);
+CREATE INDEX IF NOT EXISTS checksums_ts ON checksums (ts);
+CREATE TABLE IF NOT EXISTS delivered (cxname VARCHAR NOT NULL, targetdir VARCHAR NOT NULL, size INT NOT NULL,
+  hash VARCHAR, archived VARCHAR, remote VARCHAR NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS delivered_size ON delivered (cxname, targetdir, size);
+CREATE INDEX IF NOT EXISTS delivered_ts ON delivered (cxname, targetdir, ts);
+CREATE TABLE IF NOT EXISTS fanout (cxname VARCHAR NOT NULL, targetdir VARCHAR NOT NULL, path VARCHAR NOT NULL,
+  version VARCHAR NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS fanout_path ON fanout (path);
+CREATE TABLE IF NOT EXISTS fanout_owed (name VARCHAR NOT NULL, cxname VARCHAR NOT NULL, targetdir VARCHAR NOT NULL,
+  archived VARCHAR NOT NULL, attempts INT NOT NULL, nextat REAL NOT NULL, ts REAL NOT NULL,
+  PRIMARY KEY (cxname, targetdir, archived));
+CREATE TABLE IF NOT EXISTS retries (cxname VARCHAR NOT NULL, direction VARCHAR NOT NULL, name VARCHAR NOT NULL,
+  path VARCHAR NOT NULL, attempts INT NOT NULL, nextat REAL NOT NULL, lastrc INT, status VARCHAR NOT NULL, ts REAL NOT NULL,
+  PRIMARY KEY (cxname, direction, path));
+CREATE TABLE IF NOT EXISTS archives (source VARCHAR PRIMARY KEY, target VARCHAR NOT NULL, name VARCHAR NOT NULL, ts REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS throughput (cxname VARCHAR NOT NULL, direction VARCHAR NOT NULL, name VARCHAR NOT NULL,
+  files INT NOT NULL, bytes INT NOT NULL, seconds REAL NOT NULL, ts REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS throughput_cx ON throughput (cxname, direction);
+"""
+
+def select_columns(cur, table, columns) -> str:
+  """
+  Return the column list to SELECT from table, replacing the columns the table
+  does not have by their default value
+  """
+  cur.execute(f"PRAGMA table_info(%s)"%(table,))
+  present = [ a_row[1] for a_row in cur.fetchall() ]
+  return ", ".join([ name if (name in present or default is None) else f"%s AS %s"%(default, name)
+                     for name, default in columns ])
+
+def compile_filter(row):
+  """
+  Compile the include/exclude patterns and size and age limits of a tx/rx
+  row. Patterns are separated by commas and are globs, or regular
+  expressions when prefixed by 're:'
+  Returns None if the row does not filter
+  """
+  if not (row["include"] or row["exclude"] or row["minsize"] or row["maxsize"] or row["minage"]):
+    return None
+  flt = { "include": [], "exclude": [], "include_globs": [], "exclude_globs": [],
+          "minsize": row["minsize"], "maxsize": row["maxsize"], "minage": row["minage"], }
+  for key in ("include", "exclude"):
+    for a_pattern in (row[key] or "").split(","):
+      a_pattern = a_pattern.strip()
+      if a_pattern.startswith("re:"):
+        flt[key].append(re.compile(a_pattern[3:]).search)
+      elif a_pattern:
+        flt[key].append(re.compile(fnmatch.translate(a_pattern)).match)
+        flt[key+"_globs"].append(a_pattern)
+  if len(flt["include_globs"])<len(flt["include"]):
+    flt["include_globs"] = []               # Can't list by glob if a regex must match too
+  return flt
+
+def pass_filter(flt, name=None, size=None, age=None) -> bool:
+  """
+  Tell if a file passes a compiled filter. Only the given attributes are checked
+  """
+  if flt is None:
+    return True
+  if name is not None:
+    name = os.path.basename(name)
+    if flt["include"] and not any([ a_match(name) for a_match in flt["include"] ]):
+      return False
+    if any([ a_match(name) for a_match in flt["exclude"] ]):
+      return False
+  if size is not None:
+    if flt["minsize"] and size<flt["minsize"]:
+      return False
+    if flt["maxsize"] and size>flt["maxsize"]:
+      return False
+  if age is not None and flt["minage"] and age<flt["minage"]:
+    return False
+  return True
+
+def compile_window(row):
+  """
+  Compile the schedule window of a tx/rx row: cron-like expressions of
+  minute, hour, day of month, month and day of week fields (*, a-b, a,b and
+  /step), several separated by ';'. The row is worked on during the minutes
+  any of them matches
+  Returns None if the row has no window
+  """
+  if not row["window"]:
+    return None
+  limits = [ (0, 59,), (0, 23,), (1, 31,), (1, 12,), (0, 7,), ]
+  window = []
+  for an_expr in row["window"].split(";"):
+    fields = an_expr.split()
+    if len(fields)!=5:
+      raise ValueError(f"window '%s' in '%s' needs 5 fields"%(an_expr, row["name"],))
+    sets = []
+    for a_field, (low, high) in zip(fields, limits):
+      values = set()
+      for a_part in a_field.split(","):
+        a_range, sep, step = a_part.partition("/")
+        if a_range=="*":
+          first, last = low, high
+        else:
+          first, sep, last = a_range.partition("-")
+          first = int(first)
+          last = int(last) if last else (high if step else first)
+        if first<low or last>high:
+          raise ValueError(f"window field '%s' in '%s' out of %d-%d"%(a_field, row["name"], low, high,))
+        values.update(range(first, last+1, int(step) if step else 1))
+      sets.append(None if a_field=="*" else values)
+    if sets[4] is not None and 7 in sets[4]:
+      sets[4].add(0)                        # Both 0 and 7 are sunday
+    window.append(sets)
+  return window
+
+def in_window(window, when=None) -> bool:
+  """
+  Tell if a time (now if None) falls in a compiled schedule window. As in
+  cron, when both day fields are restricted either of them can match
+  """
+  if window is None:
+    return True
+  t = time.localtime(when)
+  for minutes, hours, days, months, weekdays in window:
+    if minutes is not None and t.tm_min not in minutes:
+      continue
+    if hours is not None and t.tm_hour not in hours:
+      continue
+    if months is not None and t.tm_mon not in months:
+      continue
+    day = days is not None and t.tm_mday in days
+    weekday = weekdays is not None and (t.tm_wday+1)%7 in weekdays
+    if days is not None and weekdays is not None:
+      if not (day or weekday):
+        continue
+    elif not (day or days is None) or not (weekday or weekdays is None):
+      continue
+    return True
+  return False
+
+def batched(row, items, now):
+  """
+  Pass the queue items (priority, size, since, row, name) of a tx/rx row
+  on once they make a batch: row["batchfiles"] files, row["batchmb"] MB, or
+  one waiting row["batchdelay"] seconds, whichever comes first. From then
+  on every item goes through; the ones held when the items end wait for a
+  later cycle
+  """
+  if not (row["batchfiles"] or row["batchmb"] or row["batchdelay"]):
+    yield from items
+    return
+  held = []
+  size = 0
+  due = False
+  for an_item in items:
+    if due:
+      yield an_item
+      continue
+    held.append(an_item)
+    size = size + an_item[1]
+    if (row["batchfiles"] and len(held)>=row["batchfiles"]) or (row["batchmb"] and size>=row["batchmb"]*1024*1024) or (row["batchdelay"] and now-an_item[2]>=row["batchdelay"]):
+      due = True
+      yield from held
+      held = []
+  if held:
+    log.info(f"---→ '%s' holding %d files (%d bytes) until they make a batch"%(row["name"], len(held), size,))
+
+def row_valid(direction, row) -> bool:
+  """
+  Check a tx/rx row when loading it: its transport and the columns it
+  combines with (see transport_of()), and compile its filter and window.
+  A bad row is logged and left out, the other rows still run
+  """
+  global Options
+  try:
+    transport_of(row)
+    Options.filters[(direction, row["name"],)] = compile_filter(row)
+    Options.windows[(direction, row["name"],)] = compile_window(row)
+  except (ValueError, re.error) as e:
+    log.error(f"%s: %s '%s' skipped, e='%s'"%(Options.PrgName, direction, row["name"], e,))
+    return False
+  return True
+
+def load_all_conf(dbfilename: str, connection=None) -> ():
   """
   Load all configurations from SQLite database and return a tuple
+  connection is the connection selector (number or name), defaults to
+             Options.connection
   """
   cx = sqlite3.connect(dbfilename)
+  cx.row_factory = sqlite3.Row  # rows by position (tx[0]) and by name (tx["priority"])
   cur = cx.cursor()
   global Options
   conf = None
   txs = None
   rxs = None
+  if connection is None:
+    connection = Options.connection
 
   # Load conn definitions
   try:
     try: # try to convert the connection argument to integer, use as text
          # if not possible
-      Options.connection = int(Options.connection)
+      connection = int(connection)
     except ValueError:
       pass
-    if type(Options.connection) is int:
+    if type(connection) is int:
          # Try to get the connection number N given
-      sql = f"SELECT id, cxname FROM cxdef WHERE id=%s"%(Options.connection,)
+      sql = f"SELECT id, cxname FROM cxdef WHERE id=%s"%(connection,)
       if Options.DEBUG:
         print(f"---→ %s"%(sql,))
       cur.execute(sql)
     else:
          # Try to get the connection with the text given
-      sql = f"SELECT id, cxname FROM cxdef WHERE cxname LIKE '%s'"%(Options.connection,)
+      sql = f"SELECT id, cxname FROM cxdef WHERE cxname LIKE '%s'"%(connection,)
       if Options.DEBUG:
         print(f"---→ %s"%(sql,), file=sys.stderr)
       cur.execute(sql)
     cxdefs = cur.fetchone()
     if Options.DEBUG:
-      print(f"<- cxdefs='%s'"%(cxdefs,), file=sys.stderr)
+      print(f"<- cxdefs='%s'"%(tuple(cxdefs) if cxdefs else None,), file=sys.stderr)
     if cxdefs:
       if Options.verbose:
         log.info(f"%s: using connection definition #%s '%s'"%(Options.PrgName, cxdefs[0], cxdefs[1]))
       cxid = cxdefs[0]
          # Try to get the directory to transfer up from
-      sql = f"SELECT sourcedir, targetdir, archivedir, sftp FROM tx WHERE cxid=%d ORDER BY id"%(cxid,)
+      sql = f"SELECT %s FROM tx WHERE cxid=%d ORDER BY id"%(select_columns(cur, "tx", TX_COLUMNS), cxid,)
       if Options.DEBUG:
         print(f"---→ '%s'"%(sql,), file=sys.stderr)
       cur.execute(sql)
-      txs = cur.fetchall()
+      txs = [ tx for tx in cur.fetchall() if row_valid("tx", tx) ]
       if Options.DEBUG:
-        print(f"<- txs='%s'"%(txs,), file=sys.stderr)
+        print(f"<- txs='%s'"%([ dict(tx) for tx in txs ],), file=sys.stderr)
          # Try to get the directory to transfer down from
-      sql = f"SELECT sourcedir, targetdir, sftp FROM rx WHERE cxid=%d ORDER BY id"%(cxid,)
+      sql = f"SELECT %s FROM rx WHERE cxid=%d ORDER BY id"%(select_columns(cur, "rx", RX_COLUMNS), cxid,)
       if Options.DEBUG:
         print(f"---→ '%s'"%(sql,), file=sys.stderr)
       cur.execute(sql)
-      rxs = cur.fetchall()
+      rxs = [ rx for rx in cur.fetchall() if row_valid("rx", rx) ]
       if Options.DEBUG:
-        print(f"<- rxs='%s'"%(rxs,), file=sys.stderr)
+        print(f"<- rxs='%s'"%([ dict(rx) for rx in rxs ],), file=sys.stderr)
 
-    conf = (cxdefs, txs, rxs)
+    conf = (tuple(cxdefs) if cxdefs else None, txs, rxs)
   except sqlite3.Error as e:
     print(f"An SQLite error occurred: e='%s'"%(e,))
     return ()  # Return an empty list in case of error
@@ -82,142 +324,1578 @@ def load_all_conf(dbfilename: str) -> ():
       return ()
   return tuple(conf)
 
-def log_filename(cx=None) -> str:
+def cx_health(cxname):
+  """
+  Return the health state of a connection, creating it closed (healthy) when
+  first seen. The states are kept in Options.health, keyed by connection name
+  """
+  global Options
+  return Options.health.setdefault(cxname, {
+    "state": "closed",   # closed: healthy, open: skip all work, half-open: probing
+    "failures": 0,       # consecutive failed operations
+    "opens": 0,          # consecutive times the circuit opened, for the backoff
+    "retry_at": 0.0,     # when an open circuit may be probed again
+    "probed_at": 0.0,    # when the last probe ran
+    "probe_ok": None,    # result of the last probe
+  })
+
+def cx_probe(cxname) -> bool:
+  """
+  Cheap probe of a connection in the style of paramigo.py: run 'exit 0' with
+  short connect timeouts. Results are cached for Options.probe_cache seconds
+  """
+  global Options
+  health = cx_health(cxname)
+  now = time.time()
+  if health["probe_ok"] is not None and now-health["probed_at"]<Options.probe_cache:
+    return health["probe_ok"]
+  full_cmd = [ Options.ssh, "-o", "BatchMode=yes", "-o", f"ConnectTimeout=%d"%(Options.probe_timeout,), cxname, "exit 0", ]
+  if Options.DEBUG:
+    log.debug(f"---→ probe full_cmd='%s'"%(full_cmd,))
+  try:
+    subprocess.run(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+      timeout=Options.probe_timeout+Options.auth_timeout, check=True)
+    probe_ok = True
+  except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+    probe_ok = False
+  health["probed_at"] = time.time()
+  health["probe_ok"] = probe_ok
+  log.info(f"%s: probe of '%s' %s in %.3fs"%(Options.PrgName, cxname, "succeeded" if probe_ok else "failed", health["probed_at"]-now,))
+  return probe_ok
+
+def cx_open(cxname):
+  """
+  Open the circuit of a connection, doubling the wait before the next probe
+  """
+  global Options
+  health = cx_health(cxname)
+  health["state"] = "open"
+  health["opens"] = health["opens"] + 1
+  backoff = min(Options.backoff * 2**(health["opens"]-1), Options.max_backoff)
+  health["retry_at"] = time.time() + backoff
+  log.error(f"%s: connection '%s' unreachable, skipping its work for %ds"%(Options.PrgName, cxname, backoff,))
+
+def cx_available(cxname) -> bool:
+  """
+  Tell if work for a connection may run now. An open circuit becomes half-open
+  once its backoff expires and a probe decides if it closes or opens again
+  """
+  health = cx_health(cxname)
+  if health["state"]=="closed":
+    return True
+  if time.time()<health["retry_at"]:
+    return False
+  health["state"] = "half-open"
+  if cx_probe(cxname):
+    log.info(f"%s: connection '%s' reachable again"%(Options.PrgName, cxname,))
+    health["state"] = "closed"
+    health["failures"] = 0
+    health["opens"] = 0
+    return True
+  cx_open(cxname)
+  return False
+
+def cx_record(cxname, rc):
+  """
+  Record the return code of an operation over a connection. After
+  Options.failures consecutive failures the connection is probed, and the
+  circuit opens only if the probe fails too (file level errors don't open it)
+  """
+  global Options
+  health = cx_health(cxname)
+  if rc==0:
+    health["failures"] = 0
+    return
+  health["failures"] = health["failures"] + 1
+  if health["failures"]>=Options.failures:
+    health["failures"] = 0
+    if not cx_probe(cxname):
+      cx_open(cxname)
+
+def schedule(items):
+  """
+  Return the work items of a cycle in the order they must be processed
+  items are tuples (priority, size, since, row, name): lower priority values go
+        first, then sizes as Options.order says, then the oldest ones. Each
+        Options.aging seconds waiting raise an item one priority level, and
+        items waiting more than Options.max_wait go first, oldest first, so
+        large or old files are never held back forever
+  """
+  global Options
+  now = time.time()
+
+  def key(item):
+    priority, size, since, row, name = item
+    waited = now - since
+    if Options.max_wait and waited>=Options.max_wait:
+      return (0, since, 0, 0)
+    if Options.aging:
+      priority = priority - int(waited//Options.aging)
+    if Options.order=="smallest":
+      size_key = size
+    elif Options.order=="largest":
+      size_key = -size
+    else: # fifo
+      size_key = 0
+    return (1, priority, size_key, since)
+
+  return sorted(items, key=key)
+
+def state_db():
+  """
+  Return the connection to the state tables kept in the configuration
+  database, creating them if needed. Old checksum, fan-out, retry and
+  throughput records are pruned once a day; quarantined files stay until
+  their retries row is deleted by hand. --plan opens it read-only, as it is
+  """
+  global Options
+  if Options.statedb is None and Options.plan:
+    Options.statedb = sqlite3.connect(f"file:%s?mode=ro"%(urllib.parse.quote(os.path.abspath(Options.confdb)),), timeout=30, isolation_level=None, uri=True)
+  elif Options.statedb is None:
+    Options.statedb = sqlite3.connect(Options.confdb, timeout=30, isolation_level=None)
+    Options.statedb.executescript(STATE_SQL)
+  if time.time()-Options.pruned_at>86400 and not Options.plan:
+    Options.pruned_at = time.time()
+    Options.statedb.execute("DELETE FROM checksums WHERE ts<datetime('now', ?)", (f"-%d days"%(Options.keep_days,),))
+    Options.statedb.execute("DELETE FROM fanout WHERE ts<?", (time.time()-Options.keep_days*86400,))
+    Options.statedb.execute("DELETE FROM fanout_owed WHERE ts<?", (time.time()-Options.keep_days*86400,))
+    Options.statedb.execute("DELETE FROM retries WHERE ts<? AND status!='quarantined'", (time.time()-Options.keep_days*86400,))
+    Options.statedb.execute("DELETE FROM throughput WHERE ts<?", (time.time()-Options.keep_days*86400,))
+  return Options.statedb
+
+def record_checksum(cx, direction, row, path, size, algorithm, localsum, remotesum):
+  """
+  Record the result of checking one transferred file
+  """
+  ok = localsum is not None and localsum==remotesum
+  try:
+    state_db().execute("INSERT INTO checksums VALUES (datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (cx, direction, row["name"], path, size, algorithm, localsum, remotesum, 1 if ok else 0,))
+  except sqlite3.Error as e:
+    log.error(f"%s: Could not record checksum of '%s' e='%s'"%(Options.PrgName, path, e,))
+  if ok:
+    log.info(f"%s: %s '%s' verified %s:%s"%(Options.PrgName, direction, path, algorithm, localsum,))
+  else:
+    log.error(f"%s: %s '%s' checksum mismatch local=%s remote=%s"%(Options.PrgName, direction, path, localsum, remotesum,))
+  return ok
+
+def part_name(a_dir, a_file) -> str:
+  """
+  Return the temporary name a file has in a_dir until it is verified
+  """
+  return os.path.join(a_dir, f".%s.part"%(os.path.basename(a_file),))
+
+def target_name(row, a_file) -> str:
+  """
+  Return the path a file gets in the target directory of a tx/rx row: tx
+  rows that compress add their suffix, rx rows that compress drop it
+  """
+  a_name = os.path.basename(a_file)
+  if row["compress"]:
+    suffix = row["suffix"] or CODECS[row["compress"]]["suffix"]
+    if "archivedir" in row.keys():
+      a_name = a_name + suffix
+    elif a_name.endswith(suffix) and len(a_name)>len(suffix):
+      a_name = a_name[:-len(suffix)]
+  return os.path.join(row[1], a_name)
+
+def codec_cmd(row, decompress=False) -> list:
+  """
+  Return the command that compresses (or decompresses) stdin to stdout with
+  the codec and level of a tx/rx row
+  """
+  full_cmd = [ getattr(Options, CODECS[row["compress"]]["bin"]), "-c", ]
+  if decompress:
+    full_cmd.append("-d")
+  elif "level" in row.keys() and row["level"]:
+    full_cmd.append(f"-%d"%(row["level"],))
+  if row["compress"]=="zstd":
+    full_cmd.append("-q")
+  return full_cmd
+
+def arg_batches(args):
+  """
+  Split a list of already quoted arguments in batches short enough for one
+  remote command line
+  """
+  batch = []
+  batch_len = 0
+  for an_arg in args:
+    if batch and batch_len+len(an_arg)>Options.max_args:
+      yield batch
+      batch = []
+      batch_len = 0
+    batch.append(an_arg)
+    batch_len = batch_len + len(an_arg) + 1
+  if batch:
+    yield batch
+
+def remote_sums(cx, algorithm, paths) -> dict:
+  """
+  Hash remote files using one remote command for the whole set (split only
+  when the argument list gets too long). Returns a dict path → checksum
+  """
+  global Options
+  sums = {}
+  for batch in arg_batches([ shlex.quote(a_path) for a_path in paths ]):
+    full_cmd = [ Options.ssh, cx, f"%s %s"%(Options.hash_cmd.replace("%s", algorithm), " ".join(batch),), ]
+    if Options.DEBUG:
+      log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+    try:
+      res = subprocess.run(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+      for a_line in res.stdout.decode("utf-8").splitlines():
+        fields = a_line.split(None, 1)
+        if len(fields)==2:
+          sums[fields[1].lstrip("*")] = fields[0].lstrip("\\").lower()
+    except OSError as e:
+      log.error(f"%s: Could not run '%s' e='%s'"%(Options.PrgName, full_cmd, e,))
+  return sums
+
+def remote_remove(cx, paths) -> int:
+  """
+  Remove remote files with one remote command for the whole set
+  """
+  global Options
+  rc = 0
+  for batch in arg_batches([ shlex.quote(a_path) for a_path in paths ]):
+    full_cmd = [ Options.ssh, cx, f"rm -f -- %s"%(" ".join(batch),), ]
+    if Options.DEBUG:
+      log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+    try:
+      subprocess.check_output(full_cmd, shell=False)
+      log.info(f"---→ rm %d files from %s"%(len(batch), cx,))
+    except subprocess.CalledProcessError as pe:
+      log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,))
+      rc = rc + pe.returncode
+  return rc
+
+def lease_db():
+  """
+  Return the connection to the shared lease database, creating its table
+  and starting the thread that renews this node's leases if needed
+  """
+  global Options
+  if Options.leasedb is None:
+    Options.leasedb = sqlite3.connect(Options.lease_db, timeout=60, isolation_level=None, check_same_thread=False)
+    Options.leasedb.execute("CREATE TABLE IF NOT EXISTS leases (item VARCHAR PRIMARY KEY, node VARCHAR NOT NULL, expires REAL NOT NULL)")
+    renewer = threading.Thread(target=lease_renewer, name="lease-renewer", daemon=True)
+    renewer.start()
+  return Options.leasedb
+
+def lease_claim(item) -> bool:
+  """
+  Try to claim an item (a file of a connection) for this node. Free items and
+  items whose lease expired are taken; items leased by other nodes are not
+  """
+  global Options
+  now = time.time()
+  with Options.lease_lock:
+    try:
+      cur = lease_db().execute("INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(item) DO UPDATE "
+        "SET node=excluded.node, expires=excluded.expires WHERE leases.expires<? OR leases.node=excluded.node",
+        (item, Options.node, now+Options.lease, now,))
+    except sqlite3.Error as e:
+      log.error(f"%s: Could not claim '%s' e='%s'"%(Options.PrgName, item, e,))
+      return False
+    if cur.rowcount!=1:
+      if Options.DEBUG:
+        log.debug(f"---→ '%s' leased by another node"%(item,))
+      return False
+    Options.leases.add(item)
+  return True
+
+def lease_done(item, ok=True):
+  """
+  Stop renewing the lease of an item. A finished item keeps its lease until
+  it expires, so nodes with an older listing don't take it again; a failed
+  one is released at once for any node to retry
+  """
+  global Options
+  with Options.lease_lock:
+    Options.leases.discard(item)
+    if not ok:
+      try:
+        lease_db().execute("DELETE FROM leases WHERE item=? AND node=?", (item, Options.node,))
+      except sqlite3.Error as e:
+        log.error(f"%s: Could not release '%s' e='%s'"%(Options.PrgName, item, e,))
+
+def lease_failed(cx, direction, path):
+  """
+  Release at once the lease of a queued file its flush could not transfer,
+  as lease_done() does for files sent directly
+  """
+  global Options
+  if Options.lease_db:
+    lease_done(f"%s:%s:%s"%(direction, cx, path,), False)
+
+def lease_renewer():
+  """
+  Renew the leases this node holds every third of their duration, so long
+  transfers keep them, and prune long expired leases
+  """
+  global Options
+  while True:
+    sleep(max(Options.lease//3, 1))
+    now = time.time()
+    with Options.lease_lock:
+      try:
+        held = list(Options.leases)
+        for start in range(0, len(held), 500):
+          some = held[start:start+500]
+          Options.leasedb.execute(f"UPDATE leases SET expires=? WHERE node=? AND item IN (%s)"%(",".join("?"*len(some)),),
+            [ now+Options.lease, Options.node, ] + some)
+        Options.leasedb.execute("DELETE FROM leases WHERE expires<?", (now-Options.lease,))
+      except sqlite3.Error as e:
+        log.error(f"%s: Could not renew leases e='%s'"%(Options.PrgName, e,))
+
+def retry_table() -> dict:
+  """
+  Return the files that failed, by (cxname, tx|rx, path): [attempts,
+  nextat, status]. Loaded from the retries state table the first time
+  """
+  global Options
+  if Options.retries is None:
+    Options.retries = {}
+    try:
+      for cxname, direction, path, attempts, nextat, status in state_db().execute(
+          "SELECT cxname, direction, path, attempts, nextat, status FROM retries"):
+        Options.retries[(cxname, direction, path,)] = [ attempts, nextat, status, ]
+    except sqlite3.Error as e:              # No table yet in a read-only --plan
+      log.error(f"%s: Could not read retries e='%s'"%(Options.PrgName, e,))
+  return Options.retries
+
+def retry_wait(cx, direction, path, now) -> bool:
+  """
+  Tell if a file must be left alone now: it is backing off after failing,
+  or it was quarantined
+  """
+  a_retry = retry_table().get((cx, direction, path,))
+  return a_retry is not None and (a_retry[2]=="quarantined" or now<a_retry[1])
+
+def retry_record(cx, direction, row, path, rc):
+  """
+  Record the result of transferring one file. A failure waits --retry-backoff
+  seconds, doubled on each attempt up to --retry-max-backoff; after
+  --retry-max attempts the file is quarantined: tx files are moved to
+  row["quarantinedir"] (or --quarantine), rx files are not tried again
+  until their retries row is deleted. Failures of the connection itself
+  (ssh's 255, or the circuit opening) don't count against the file
+  """
+  global Options
+  key = (cx, direction, path,)
+  retries = retry_table()
+  if rc==0:
+    if key in retries:
+      del retries[key]
+      state_db().execute("DELETE FROM retries WHERE cxname=? AND direction=? AND path=?", key)
+    return
+  if rc==255 or cx_health(cx)["state"]!="closed":
+    return
+  attempts = retries.get(key, [ 0, ])[0] + 1
+  nextat = time.time() + min(Options.retry_backoff*2**(attempts-1), Options.retry_max_backoff)
+  status = "retry"
+  if attempts>=Options.retry_max:
+    status = "quarantined"
+    quarantine_dir = (row["quarantinedir"] or Options.quarantine) if direction=="tx" else None
+    if quarantine_dir:
+      try:
+        os.makedirs(quarantine_dir, exist_ok=True)
+        os.rename(path, os.path.join(quarantine_dir, os.path.basename(path)))
+        log.error(f"%s: '%s' failed %d times, moved to '%s'"%(Options.PrgName, path, attempts, quarantine_dir,))
+      except OSError as e:
+        log.error(f"%s: Could not quarantine '%s' e='%s'"%(Options.PrgName, path, e,))
+        status = "retry"
+    else:
+      log.error(f"%s: %s:%s failed %d times, quarantined"%(Options.PrgName, cx, path, attempts,))
+  else:
+    log.info(f"---→ %s:%s failed %d times, next try in %ds"%(cx, path, attempts, nextat-time.time(),))
+  retries[key] = [ attempts, nextat, status, ]
+  try:
+    state_db().execute("INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (cx, direction, row["name"], path, attempts, nextat, rc, status, time.time(),))
+  except sqlite3.Error as e:
+    log.error(f"%s: Could not record retry of '%s' e='%s'"%(Options.PrgName, path, e,))
+
+def stat_add(direction, row, ok, size=0, seconds=0.0):
+  """
+  Account one file of a tx/rx row (or one failed listing) for the summary
+  """
+  global Options
+  a_stat = Options.stats.setdefault((direction, row["name"],), { "files": 0, "failed": 0, "bytes": 0, "seconds": 0.0, })
+  if ok:
+    a_stat["files"] = a_stat["files"] + 1
+    a_stat["bytes"] = a_stat["bytes"] + size
+  else:
+    a_stat["failed"] = a_stat["failed"] + 1
+  a_stat["seconds"] = a_stat["seconds"] + seconds
+
+def stat_flush(direction, pending, seconds):
+  """
+  Share the time an end-of-cycle flush took among the rows of its items
+  """
+  for an_item in pending:
+    a_stat = Options.stats.setdefault((direction, an_item[0]["name"],), { "files": 0, "failed": 0, "bytes": 0, "seconds": 0.0, })
+    a_stat["seconds"] = a_stat["seconds"] + seconds/len(pending)
+
+def report_stats() -> int:
+  """
+  Print and log a line per tx/rx row with the files, bytes and time of the run
+  Returns the exit code: 0 all went well, 5 some files failed, 6 all failed
+  """
+  global Options
+  files = 0
+  failed = 0
+  for (direction, name), a_stat in sorted(Options.stats.items()):
+    line = f"%s %-20s %6d files %12d bytes %4d failed %8.2fs"%(direction, name, a_stat["files"], a_stat["bytes"], a_stat["failed"], a_stat["seconds"],)
+    print(line)
+    log.info(f"%s: %s"%(Options.PrgName, line,))
+    files = files + a_stat["files"]
+    failed = failed + a_stat["failed"]
+  if failed==0:
+    return 0
+  return 5 if files>0 else 6
+
+def throughput_record(confs):
+  """
+  Record the files, bytes and seconds each tx/rx row moved since the last
+  record, the history throughput_of() fits
+  """
+  global Options
+  now = time.time()
+  for conf in confs:
+    for direction, rows in (("tx", conf[1],), ("rx", conf[2],),):
+      for row in rows:
+        a_stat = Options.stats.get((direction, row["name"],))
+        if a_stat is None:
+          continue
+        last = Options.recorded.get((direction, row["name"],), { "files": 0, "bytes": 0, "seconds": 0.0, })
+        Options.recorded[(direction, row["name"],)] = dict(a_stat)
+        if a_stat["files"]==last["files"]:
+          continue
+        try:
+          state_db().execute("INSERT INTO throughput VALUES (?, ?, ?, ?, ?, ?, ?)", (conf[0][1], direction, row["name"],
+            a_stat["files"]-last["files"], a_stat["bytes"]-last["bytes"], a_stat["seconds"]-last["seconds"], now,))
+        except sqlite3.Error as e:
+          log.error(f"%s: Could not record throughput of '%s' e='%s'"%(Options.PrgName, row["name"], e,))
+
+def throughput_of(cxname, direction):
+  """
+  Fit seconds = files*overhead + bytes/rate by least squares to the cycles
+  recorded for a connection and direction
+  Returns a dict with the overhead in seconds per file, the seconds per
+  byte, the cycles fitted and the fraction of time spent transferring, or
+  None without history
+  """
+  try:
+    records = state_db().execute("SELECT files, bytes, seconds, ts FROM throughput WHERE cxname=? AND direction=?", (cxname, direction,)).fetchall()
+  except sqlite3.Error as e:
+    log.error(f"%s: Could not read throughput of '%s' e='%s'"%(Options.PrgName, cxname, e,))
+    return None
+  if not records:
+    return None
+  sff = sum([ files*files for files, size, seconds, ts in records ])
+  sfb = sum([ files*float(size) for files, size, seconds, ts in records ])
+  sbb = sum([ float(size)*size for files, size, seconds, ts in records ])
+  sfs = sum([ files*seconds for files, size, seconds, ts in records ])
+  sbs = sum([ size*seconds for files, size, seconds, ts in records ])
+  det = sff*sbb - sfb*sfb
+  overhead, per_byte = -1.0, -1.0
+  if det>1e-9*sff*sbb:
+    overhead = (sfs*sbb - sbs*sfb)/det
+    per_byte = (sff*sbs - sfb*sfs)/det
+  if overhead<0 or per_byte<0:              # Too few or too alike cycles, fit one term
+    if overhead>=0 or sbb==0:
+      overhead, per_byte = sfs/sff, 0.0
+    else:
+      overhead, per_byte = 0.0, sbs/sbb
+  first = min([ ts for files, size, seconds, ts in records ])
+  last = max([ ts for files, size, seconds, ts in records ])
+  busy = sum([ seconds for files, size, seconds, ts in records if ts>first ])/(last-first) if last>first else 0.0
+  return { "overhead": overhead, "per_byte": per_byte, "cycles": len(records), "busy": busy, }
+
+def plan_cycle(confs) -> int:
+  """
+  Dry run of a cycle: scan the tx source directories and list the rx remote
+  directories of the selected connections with the filters, windows,
+  batches and ordering of a real cycle, without transferring anything.
+  The time of each file is estimated from the throughput recorded for its
+  connection; a row whose last file would end past the -w interval misses
+  it. The backlog of each connection drains in its estimated time over
+  the fraction of time not taken by the usual load. Rows whose listing
+  failed are not estimated and count as missing it
+  Returns 0 if every row fits, 8 if some row would miss its interval
+  """
+  global Options
+  interval = Options.wait if Options.seconds else 60*Options.wait
+  elapsed = 0.0
+  missed = 0
+  for conf in confs:
+    cx = conf[0]
+    now = time.time()
+    for direction, rows in (("tx", conf[1],), ("rx", conf[2],),):
+      model = throughput_of(cx[1], direction)
+      if model is None:
+        line = f"%s %s no throughput recorded, times not estimated"%(cx[1], direction,)
+      else:
+        line = f"%s %s %.3fs per file %s fitted to %d cycles, busy %.0f%%"%(cx[1], direction, model["overhead"],
+          f"%.2f MB/s"%(1.0/model["per_byte"]/1024/1024,) if model["per_byte"] else "size not significant", model["cycles"], 100*model["busy"],)
+      print(line)
+      log.info(f"%s: %s"%(Options.PrgName, line,))
+      windows = [ [], ]                     # Scheduled together, as receive_all() does
+      listed = {}
+      for row in rows:
+        if not in_window(Options.windows.get((direction, row["name"],)), now):
+          print(f"%s %-20s out of its window"%(direction, row["name"],))
+          continue
+        if direction=="tx":
+          items = scan_tx(cx, row, now) if os.path.isdir(row[0]) else []
+        else:
+          items = list(list_all(cx, row, now))
+          if (cx[1], row["name"],) in Options.list_failed:
+            missed = missed + 1
+            line = f"%s %-20s listing failed, not estimated"%(direction, row["name"],)
+            print(line)
+            log.info(f"%s: %s"%(Options.PrgName, line,))
+            continue
+        listed[row["name"]] = len(items)
+        for an_item in batched(row, items, now):
+          windows[-1].append(an_item)
+          if direction=="rx" and len(windows[-1])>=Options.in_flight:
+            windows.append([])
+      plans = {}
+      started = elapsed
+      for a_window in windows:
+        for priority, size, since, row, a_file in schedule(a_window):
+          a_plan = plans.setdefault(row["name"], { "files": 0, "bytes": 0, "seconds": 0.0, "ends": 0.0, })
+          seconds = model["overhead"] + size*model["per_byte"] if model else 0.0
+          elapsed = elapsed + seconds
+          a_plan["files"] = a_plan["files"] + 1
+          a_plan["bytes"] = a_plan["bytes"] + size
+          a_plan["seconds"] = a_plan["seconds"] + seconds
+          a_plan["ends"] = elapsed
+      for name, count in listed.items():
+        a_plan = plans.get(name, { "files": 0, "bytes": 0, "seconds": 0.0, "ends": 0.0, })
+        misses = model is not None and a_plan["ends"]>interval
+        missed = missed + (1 if misses else 0)
+        line = f"%s %-20s %6d files %12d bytes %4d held %8.2fs ends at %8.2fs %s"%(direction, name, a_plan["files"], a_plan["bytes"],
+          count-a_plan["files"], a_plan["seconds"], a_plan["ends"], f"MISSES the %ds interval"%(interval,) if misses else "fits",)
+        print(line)
+        log.info(f"%s: %s"%(Options.PrgName, line,))
+      if model is not None and elapsed>started:
+        backlog = elapsed - started
+        line = f"%s %s backlog of %.2fs drains in %s"%(cx[1], direction, backlog,
+          f"%.2fs"%(backlog/(1.0-model["busy"]),) if model["busy"]<1.0 else "never, the usual load fills the time",)
+        print(line)
+        log.info(f"%s: %s"%(Options.PrgName, line,))
+  line = f"cycle estimated at %.2fs of a %ds interval, %d rows miss it"%(elapsed, interval, missed,)
+  print(line)
+  log.info(f"%s: %s"%(Options.PrgName, line,))
+  return 8 if missed else 0
+
+def run_lock(lock_file):
+  """
+  Lock a file so overlapping runs for the same connections skip instead of
+  colliding. Returns the open lock file, None if another run holds it
+  """
+  lock = open(lock_file, "a")
+  try:
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+  except OSError:
+    lock.close()
+    return None
+  lock.truncate(0)
+  lock.write(f"%d\n"%(os.getpid(),))
+  lock.flush()
+  return lock
+
+def phase(name) -> str:
+  """
+  Charge the time since the last switch to the running phase of the cycle
+  and start phase name. Returns the phase that was running, to switch back
+  """
+  global Options
+  now = time.time()
+  running, since = Options.phase
+  Options.cycle[running] = Options.cycle.get(running, 0.0) + now - since
+  Options.phase = (name, now,)
+  return running
+
+def cycle_done():
+  """
+  Close a cycle: the time of each phase goes to the rolling histograms of
+  the last --timing-cycles cycles, and the profiler is stopped after
+  --profile cycles
+  """
+  global Options
+  phase(Options.phase[0])
+  for name in PHASES:
+    Options.timings.setdefault(name, collections.deque(maxlen=Options.timing_cycles)).append(Options.cycle.get(name, 0.0))
+  Options.cycle = {}
+  Options.cycles = Options.cycles + 1
+  if Options.profiler and Options.cycles>=Options.profile:
+    profile_dump()
+
+def report_timings(signum=None, frame=None):
+  """
+  Log the rolling histogram of each phase: percentiles and counts by bucket
+  Also the SIGUSR1 handler
+  """
+  for name in PHASES:
+    values = sorted(Options.timings.get(name, []))
+    if not values or log is None:
+      continue
+    buckets = [ 0 ]*(len(HISTOGRAM)+1)
+    for a_value in values:
+      buckets[len([ a_bound for a_bound in HISTOGRAM if a_bound<=a_value ])] += 1
+    log.info(f"%s: %-8s %d cycles p50 %.3fs p90 %.3fs max %.3fs [%s >=%gs:%d]"%(Options.PrgName, name, len(values),
+      values[len(values)//2], values[len(values)*9//10], values[-1],
+      " ".join([ f"<%gs:%d"%(a_bound, a_count,) for a_bound, a_count in zip(HISTOGRAM, buckets) ]), HISTOGRAM[-1], buckets[-1],))
+
+def profile_dump():
+  """
+  Stop the profiler and write its statistics next to the log file
+  """
+  global Options
+  Options.profiler.disable()
+  profile_file = os.path.splitext(Options.logfile or log_filename())[0] + ".prof"
+  try:
+    Options.profiler.dump_stats(profile_file)
+    log.info(f"%s: profile of %d cycles written to '%s'"%(Options.PrgName, Options.cycles, profile_file,))
+  except OSError as e:
+    log.error(f"%s: Could not write profile '%s' e='%s'"%(Options.PrgName, profile_file, e,))
+  Options.profiler = None
+
+def shutdown_report():
+  """
+  Report the cycle timings, and the profile if still running, at exit
+  """
+  if Options.profiler:
+    profile_dump()
+  report_timings()
+
+def log_filename(cx=None) -> str:
+  """
+  Return a log filename
+  """
+  if cx:
+    log_file = os.path.join(os.getcwd(), os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]) + f".%s.log"%(cx[1],)
+  else:
+    log_file = os.path.join(os.getcwd(), os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]) + f".log"
+  return log_file
+
+def set_logging(add_screen=True):
+  """
+  Configure logging
+  """
+  global Options
+  if Options.dolog:
+    Options.log = logging.getLogger("INODO")
+    if Options.DEBUG:
+      Options.log.setLevel(logging.DEBUG)
+    else:
+      Options.log.setLevel(logging.INFO)
+    log_handler = logging.handlers.TimedRotatingFileHandler(Options.logfile,
+      when="M",        # Rotar mensualmente
+      interval=1,      # Logs de a 1 mes
+      backupCount=36,  # 36 meses o 3 años de logs
+    )
+    log_formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    log_handler.setFormatter(log_formatter)
+    if add_screen:
+      screen_handler = logging.StreamHandler()
+      screen_formatter = logging.Formatter("%(levelname)s %(message)s")
+      screen_handler.setFormatter(screen_formatter)
+    # Clear handlers and re-add
+    # Clear
+    for a_handler in Options.log.handlers:
+      Options.log.removeHandler(a_handler)
+    # Re-add
+    Options.log.addHandler(log_handler)
+    if add_screen:
+      Options.log.addHandler(screen_handler)
+    return Options.log
+
+def archive_one(tx, the_file):
+  """
+  Move a transmitted file to the archive directory tx[2], if the row has
+  one. An archive on another filesystem is left to the archiver thread,
+  see archive_later()
+  """
+  source_file = os.path.join(tx[0], the_file)
+  if not tx[2]:
+    if Options.DEBUG:
+      log.debug(f"---→ tx='%s' has no archive directory, '%s' left in place"%(tx["name"], source_file,))
+    return 0
+  running = phase("archive")
+  try:                                      # Try to move
+    if Options.DEBUG:
+      log.debug(f"mv '%s' '%s'"%(source_file, os.path.join(tx[2], the_file),))
+    os.rename(source_file, os.path.join(tx[2], the_file)) # tx[2] == arch directory
+    log.info(f"'%s' moved to '%s'"%(source_file, os.path.join(tx[2], the_file),))
+    return 0
+  except OSError as e:
+    if e.errno==errno.EXDEV:
+      return archive_later(tx, source_file, os.path.join(tx[2], the_file))
+    log.error(f"Could not move '%s' to '%s' e='%s'"%(source_file, tx[2], e,))
+    return 1
+  finally:
+    phase(running)
+
+def archive_later(tx, source_file, target_file) -> int:
+  """
+  Queue the copy and unlink of a file whose archive is on another
+  filesystem. The operation is recorded in the archives state table first,
+  so after a restart it is queued again instead of the file being sent twice
+  """
+  global Options
+  try:
+    state_db().execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?)", (source_file, target_file, tx["name"], time.time(),))
+  except sqlite3.Error as e:
+    log.error(f"%s: Could not record archiving '%s' e='%s'"%(Options.PrgName, source_file, e,))
+    return archive_copy(source_file, target_file)
+  Options.archiving[source_file] = target_file
+  archiver().put((source_file, target_file,))
+  if Options.DEBUG:
+    log.debug(f"---→ '%s' queued for '%s'"%(source_file, target_file,))
+  return 0
+
+def archive_copy(source_file, target_file) -> int:
+  """
+  Archive a file across filesystems: copy it under a temporary name, sync
+  it, rename it into place and unlink the source
+  """
+  temp_file = part_name(os.path.dirname(target_file), target_file)
+  try:
+    if not os.path.exists(source_file):     # Done before a restart
+      if not os.path.exists(target_file):
+        log.error(f"'%s' is gone, not archived to '%s'"%(source_file, target_file,))
+      return 0
+    st = os.stat(source_file)
+    copy_kernel(source_file, temp_file)
+    os.utime(temp_file, ns=(st.st_atime_ns, st.st_mtime_ns,))
+    with open(temp_file, "rb") as a_copy:
+      os.fsync(a_copy.fileno())
+    os.rename(temp_file, target_file)
+    os.unlink(source_file)
+  except OSError as e:
+    log.error(f"Could not copy '%s' to '%s' e='%s'"%(source_file, target_file, e,))
+    return 1
+  log.info(f"'%s' copied to '%s'"%(source_file, target_file,))
+  return 0
+
+def archiver():
+  """
+  Return the queue of the archiver thread, starting it if needed. The thread
+  runs archive_copy() on each queued (source, target) and hands the results
+  back through Options.archived for archive_reap()
+  """
+  global Options
+  if Options.archive_queue is None:
+    Options.archive_queue = queue.Queue()
+    def run():
+      while True:
+        source_file, target_file = Options.archive_queue.get()
+        Options.archived.put((source_file, target_file, archive_copy(source_file, target_file),))
+        Options.archive_queue.task_done()
+    threading.Thread(target=run, name="archiver", daemon=True).start()
+  return Options.archive_queue
+
+def archive_reap(wait=False):
+  """
+  Forget the archive operations the archiver thread finished, queueing
+  again the failed ones. With wait, finish the queued ones first
+  """
+  global Options
+  if Options.archive_queue is None:
+    return
+  if wait:
+    Options.archive_queue.join()
+  failed = []
+  while True:
+    try:
+      source_file, target_file, rc = Options.archived.get_nowait()
+    except queue.Empty:
+      break
+    if rc!=0:
+      failed.append((source_file, target_file,))
+      continue
+    Options.archiving.pop(source_file, None)
+    try:
+      state_db().execute("DELETE FROM archives WHERE source=?", (source_file,))
+    except sqlite3.Error as e:
+      log.error(f"%s: Could not forget archiving '%s' e='%s'"%(Options.PrgName, source_file, e,))
+  if not wait:
+    for an_operation in failed:
+      Options.archive_queue.put(an_operation)
+
+def archive_resume(txs):
+  """
+  Queue again the archive operations of the tx rows left by a previous run
+  """
+  global Options
+  names = [ tx["name"] for tx in txs ]
+  try:
+    operations = state_db().execute(f"SELECT source, target FROM archives WHERE name IN (%s)"%(", ".join("?"*len(names)),), names).fetchall()
+  except sqlite3.Error as e:
+    log.error(f"%s: Could not read pending archive operations e='%s'"%(Options.PrgName, e,))
+    return
+  for source_file, target_file in operations:
+    Options.archiving[source_file] = target_file
+    archiver().put((source_file, target_file,))
+  if operations:
+    log.info(f"%s: resuming %d archive operations"%(Options.PrgName, len(operations),))
+
+def transmit_one_scp(cx, tx, the_file):
+  """
+  Try to transmit one file using SCP
+  cx       has the connection data. Must match something in $HOME/.ssh/config
+  tx       has the data for transmissions: local directory source, remote directory
+           target, local archive directory
+  the_file has the basename of the file to transmit
+  """
+  cmd = Options.scp
+  source_file = os.path.join(tx[0], the_file)
+  full_cmd = f"%s %s %s:%s"%(cmd, source_file, cx, tx[1],)
+  rc = 0
+  if Options.DEBUG:
+    log.debug(f"---→ '%s'"%(full_cmd,))
+  try:                                      # Try to transmit
+    cx_lines = ""
+    cx_lines = subprocess.check_output(full_cmd.split(), shell=False)
+    cx_lines = cx_lines.decode('utf-8')
+    if Options.DEBUG and (len(cx_lines)>0):
+      log.debug(f"---→ %s"%(cx_lines,))
+      sys.stderr.flush()
+    if not Options.DEBUG:
+      log.info(f"-> %s => %s:%s"%(source_file, cx, tx[1],))
+  except subprocess.CalledProcessError as pe:
+    if pe.returncode!=0:
+      log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,))
+      rc = pe.returncode
+  if rc!=0:                                 # Keep it for the next cycle
+    return rc
+  archive_one(tx, the_file)
+  return rc
+
+def sftp_quote(a_path) -> str:
+  """
+  Quote a path for an sftp command line
+  """
+  return '"%s"'%(a_path.replace("\\", "\\\\").replace('"', '\\"'),)
+
+def sftp_glob(a_glob) -> str:
+  """
+  Escape a glob for an sftp command line: sftp takes wildcards inside
+  quotes literally, so only blanks and quotes are escaped
+  """
+  return re.sub(r'[\s"\']', lambda m: "\\" + m.group(0), a_glob)
+
+def sftp_session(cx, session=None):
+  """
+  Return the sftp process of a connection, started with 'sftp -b -' and
+  fed commands over stdin. A new one is started if there is none or it
+  died; its startup messages are read up to a first mark. A named session
+  is a second process of the connection, so listings stream in while the
+  transfers of their names use the first one
+  Returns None if sftp could not connect
+  """
+  global Options
+  key = (cx, session,) if session else cx
+  proc = Options.sftps.get(key)
+  if proc is not None and proc.poll() is None:
+    return proc
+  full_cmd = [ Options.sftp, "-b", "-", cx, ]
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  try:
+    proc = subprocess.Popen(full_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError as e:
+    log.error(f"%s: Could not run '%s' e='%s'"%(Options.PrgName, full_cmd, e,))
+    return None
+  Options.sftps[key] = proc
+  try:
+    for a_line in sftp_lines(cx, [], proc, check=False, session=session):
+      pass
+  except subprocess.CalledProcessError as pe:
+    if pe.returncode==255:
+      return None
+  return proc
+
+def sftp_drop(cx, session=None):
+  """
+  Stop the sftp process of a connection, the next command starts a new one
+  """
+  proc = Options.sftps.pop((cx, session,) if session else cx, None)
+  if proc is not None and proc.poll() is None:
+    proc.kill()
+    proc.wait()
+
+def sftp_lines(cx, sftp_cmds, proc=None, check=True, session=None):
+  """
+  Run sftp commands in the sftp process of a connection and yield their
+  output lines as they arrive. Each batch ends with '!echo MARK' to stdout
+  and to stderr, so its end is found in both; anything on stderr before
+  the mark is an error, raised as subprocess.CalledProcessError(1) after
+  the lines (unless check is False). A dead process raises 255 and is
+  restarted by the next batch. Closing the generator early drops the
+  process, its pending output can't be told from the next batch's
+  session selects the sftp process, see sftp_session()
+  """
+  global Options
+  if proc is None:
+    proc = sftp_session(cx, session)
+    if proc is None:
+      raise subprocess.CalledProcessError(255, Options.sftp)
+  Options.sftp_mark = Options.sftp_mark + 1
+  mark = f"--davitrans-mark-%d--"%(Options.sftp_mark,)
+  finished = False
+  errors = []
+  try:
+    batch = "".join([ f"-%s\n"%(a_cmd,) for a_cmd in sftp_cmds ]) + f"!echo %s\n!echo %s >&2\n"%(mark, mark,)
+    if Options.DEBUG:
+      log.debug(f"---→ %s: sftp_cmds='%s'"%(cx, sftp_cmds,))
+    proc.stdin.write(batch.encode("utf-8"))
+    proc.stdin.flush()
+    for a_line in iter(proc.stdout.readline, b""):
+      a_line = a_line.decode("utf-8", "replace").rstrip("\n")
+      if a_line==mark:
+        break
+      yield a_line
+    else:
+      raise BrokenPipeError()
+    for a_line in iter(proc.stderr.readline, b""):
+      a_line = a_line.decode("utf-8", "replace").rstrip("\n")
+      if a_line==mark:
+        break
+      errors.append(a_line)
+    else:
+      raise BrokenPipeError()
+    finished = True
+  except (BrokenPipeError, ValueError):
+    try:
+      proc.wait(timeout=Options.probe_timeout)
+      reason = " ".join(errors + proc.stderr.read().decode("utf-8", "replace").split("\n")).strip()
+    except (subprocess.TimeoutExpired, OSError, ValueError):
+      reason = ""
+    log.info(f"---→ sftp to '%s' ended: %s"%(cx, reason,))
+    sftp_drop(cx, session)
+    raise subprocess.CalledProcessError(255, Options.sftp)
+  finally:
+    if not finished:
+      sftp_drop(cx, session)
+  if errors and check:
+    log.info(f"---→ sftp to '%s': %s"%(cx, " ".join(errors),))
+    raise subprocess.CalledProcessError(1, Options.sftp)
+
+def sftp_run(cx, sftp_cmds) -> int:
+  """
+  Run sftp commands in the sftp process of a connection
+  Returns rc: 0, 1 if a command failed, 255 if sftp died
+  """
+  try:
+    for a_line in sftp_lines(cx, sftp_cmds):
+      if Options.DEBUG:
+        log.debug(f"<- %s"%(a_line,))
+  except subprocess.CalledProcessError as pe:
+    return pe.returncode
+  return 0
+
+def transmit_one_sftp(cx, tx, the_file):
+  """
+  Try to transmit one file using SFTP
+  cx       has the connection data. Must match something in $HOME/.ssh/config
+  tx       has the data for transmissions: local directory source, remote directory
+           target, local archive directory
+  the_file has the basename of the file to transmit
+  """
+  source_file = os.path.join(tx[0], the_file)
+  sftp_cmd = f"put %s %s"%(sftp_quote(source_file), sftp_quote(tx[1]),)
+  rc = sftp_run(cx, [ sftp_cmd ])
+  if rc!=0:
+    log.info(f"---→ using '%s' on %s returned %d"%(sftp_cmd, cx, rc,))
+    return rc
+  log.info(f"-> %s"%(sftp_cmd,))
+  archive_one(tx, the_file)
+  return rc
+
+def transmit_one_stream(cx, tx, the_file):
+  """
+  Try to transmit one file through an ssh pipe, computing its checksum with
+  the algorithm in tx["checksum"] while it is read, so it is read only once.
+  Rows that compress pipe the file through their codec on the way and the
+  checksum and size are the ones of the compressed stream.
+  The remote copy keeps a temporary name until verify_uploads() checks it,
+  without checksum it is renamed as soon as it is complete (for rows that
+  compress, once the codec ended well)
+  Returns (rc, checksum, size)
+  """
+  global Options
+  rc = 0
+  source_file = os.path.join(tx[0], the_file)
+  remote_file = part_name(tx[1], target_name(tx, the_file))
+  remote_cmd = f"cat > %s"%(shlex.quote(remote_file),)
+  move_cmd = f"mv -f %s %s"%(shlex.quote(remote_file), shlex.quote(target_name(tx, the_file)),)
+  if not tx["checksum"] and not tx["compress"]:
+    remote_cmd = f"%s && %s"%(remote_cmd, move_cmd,)
+  full_cmd = [ Options.ssh, cx, remote_cmd, ]
+  hasher = hashlib.new(tx["checksum"]) if tx["checksum"] else None
+  size = 0
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  try:
+    with open(source_file, "rb") as source:
+      codec = None
+      if tx["compress"]:
+        codec = subprocess.Popen(codec_cmd(tx), stdin=source, stdout=subprocess.PIPE)
+        source = codec.stdout
+      proc = subprocess.Popen(full_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+      try:
+        for chunk in iter(lambda: source.read(Options.chunk), b""):
+          if hasher:
+            hasher.update(chunk)
+          size = size + len(chunk)
+          proc.stdin.write(chunk)
+        proc.stdin.close()
+      except BrokenPipeError:
+        pass
+      rc = proc.wait()
+      if codec:
+        codec.stdout.close()
+        if codec.wait()!=0 and rc==0:
+          log.error(f"Could not compress '%s' using '%s'"%(source_file, codec_cmd(tx),))
+          rc = 1
+        elif rc==0 and not hasher:
+          full_cmd = [ Options.ssh, cx, move_cmd, ]
+          rc = subprocess.call(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+  except OSError as e:
+    log.error(f"Could not send '%s' e='%s'"%(source_file, e,))
+    rc = 1
+  if rc!=0:
+    log.info(f"---→ using '%s' returned %d"%(full_cmd, rc,))
+    return (rc, None, size,)
+  log.info(f"-> %s => %s:%s"%(source_file, cx, remote_file if hasher else tx[1],))
+  return (rc, hasher.hexdigest() if hasher else None, size,)
+
+def verify_uploads(cx, uploads):
+  """
+  Check the streamed uploads of a cycle against the remote copies with one
+  batched remote hashing command, publish the good ones under their final
+  name and archive them. Bad copies are removed and their files stay queued
+  uploads has tuples (tx, the_file, checksum, sent, size), sent the bytes
+  streamed and size the one of the source file
+  Returns the number of files that could not be verified
+  """
+  global Options
+  failed = 0
+  by_algorithm = {}
+  for an_upload in uploads:
+    by_algorithm.setdefault(an_upload[0]["checksum"], []).append(an_upload)
+  for algorithm, some_uploads in by_algorithm.items():
+    sums = remote_sums(cx, algorithm, [ part_name(tx[1], target_name(tx, the_file)) for tx, the_file, checksum, sent, size in some_uploads ])
+    moves = []
+    for tx, the_file, checksum, sent, size in some_uploads:
+      remote_file = part_name(tx[1], target_name(tx, the_file))
+      final_file = target_name(tx, the_file)
+      if record_checksum(cx, "tx", tx, final_file, sent, algorithm, checksum, sums.get(remote_file)):
+        moves.append(f"mv -f %s %s && echo %s"%(shlex.quote(remote_file), shlex.quote(final_file), shlex.quote(final_file),))
+      else:
+        moves.append(f"rm -f %s"%(shlex.quote(remote_file),))
+    full_cmd = [ Options.ssh, cx, "; ".join(moves), ]
+    if Options.DEBUG:
+      log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+    try:
+      res = subprocess.run(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+      published = res.stdout.decode("utf-8").splitlines()
+    except OSError as e:
+      log.error(f"%s: Could not run '%s' e='%s'"%(Options.PrgName, full_cmd, e,))
+      published = []
+    for tx, the_file, checksum, sent, size in some_uploads:
+      if target_name(tx, the_file) in published:
+        archive_one(tx, the_file)
+        if tx["dedup"]:
+          dedup_record(cx, tx, the_file, size, checksum if algorithm=="sha256" and not tx["compress"] else None)
+        stat_add("tx", tx, True, sent)
+        retry_record(cx, "tx", tx, os.path.join(tx[0], the_file), 0)
+      else:
+        stat_add("tx", tx, False)
+        retry_record(cx, "tx", tx, os.path.join(tx[0], the_file), 1)
+        lease_failed(cx, "tx", os.path.join(tx[0], the_file))
+        failed = failed + 1
+  return failed
+
+def delta_offset(cx, source_file, final_file) -> int:
+  """
+  Return how many bytes of source_file the remote final_file already has
+  when the file only grew since it was sent: the remote copy is not longer
+  and its first and last Options.delta_block bytes match the local ones at
+  the same offsets. Returns 0 when the whole file has to be sent
+  """
+  global Options
+  block = Options.delta_block
+  hash_cmd = Options.hash_cmd.replace("%s", "sha256")
+  remote_file = shlex.quote(final_file)
+  remote_cmd = f"wc -c < %s && head -c %d %s | %s && tail -c %d %s | %s"%(remote_file, block, remote_file, hash_cmd, block, remote_file, hash_cmd,)
+  full_cmd = [ Options.ssh, cx, remote_cmd, ]
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  try:
+    res = subprocess.run(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    lines = res.stdout.decode("utf-8").splitlines()
+    if res.returncode!=0 or len(lines)!=3:
+      return 0
+    size = int(lines[0])
+    if size==0 or size>os.path.getsize(source_file):
+      return 0
+    with open(source_file, "rb") as source:
+      head = source.read(min(block, size))
+      source.seek(max(0, size-block))
+      tail = source.read(min(block, size))
+  except (OSError, ValueError) as e:
+    log.error(f"Could not compare '%s' with '%s:%s' e='%s'"%(source_file, cx, final_file, e,))
+    return 0
+  if hashlib.sha256(head).hexdigest()!=lines[1].split()[0].lstrip("\\").lower() or hashlib.sha256(tail).hexdigest()!=lines[2].split()[0].lstrip("\\").lower():
+    return 0
+  return size
+
+def transmit_one_delta(cx, tx, the_file) -> int:
+  """
+  Transmit one file sending only what the remote copy lacks, and archive it.
+  tx["delta"] 'append' sends the bytes past delta_offset() onto a copy of
+  the remote file that is renamed into place once complete (and checked,
+  with tx["checksum"]); 'rsync' lets rsync send the changed blocks, it also
+  renames its rebuilt copy into place
+  """
+  global Options
+  rc = 0
+  source_file = os.path.join(tx[0], the_file)
+  final_file = target_name(tx, the_file)
+  remote_file = part_name(tx[1], the_file)
+  if tx["delta"]=="rsync":
+    full_cmd = [ Options.rsync, "-t", "--no-whole-file", "-e", Options.ssh, source_file, f"%s:%s"%(cx, final_file,), ]
+    offset = None
+  else:
+    offset = delta_offset(cx, source_file, final_file)
+    remote_cmd = f"cat >> %s"%(shlex.quote(remote_file),) if offset else f"cat > %s"%(shlex.quote(remote_file),)
+    if offset:
+      remote_cmd = f"cp -p %s %s && %s"%(shlex.quote(final_file), shlex.quote(remote_file), remote_cmd,)
+    if not tx["checksum"]:
+      remote_cmd = f"%s && mv -f %s %s"%(remote_cmd, shlex.quote(remote_file), shlex.quote(final_file),)
+    full_cmd = [ Options.ssh, cx, remote_cmd, ]
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  try:
+    if offset is None:
+      rc = subprocess.call(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    else:
+      with open(source_file, "rb") as source:
+        source.seek(offset)
+        proc = subprocess.Popen(full_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        try:
+          for chunk in iter(lambda: source.read(Options.chunk), b""):
+            proc.stdin.write(chunk)
+          proc.stdin.close()
+        except BrokenPipeError:
+          pass
+        rc = proc.wait()
+      if rc==0 and tx["checksum"]:
+        size = os.path.getsize(source_file)
+        if not record_checksum(cx, "tx", tx, final_file, size, tx["checksum"], file_sum(source_file, tx["checksum"]),
+            remote_sums(cx, tx["checksum"], [ remote_file ]).get(remote_file)):
+          rc = 1
+        else:
+          rc = subprocess.call([ Options.ssh, cx, f"mv -f %s %s"%(shlex.quote(remote_file), shlex.quote(final_file),), ],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+  except OSError as e:
+    log.error(f"Could not send '%s' e='%s'"%(source_file, e,))
+    rc = 1
+  if rc!=0:
+    log.info(f"---→ using '%s' returned %d"%(full_cmd, rc,))
+    return rc
+  if offset is None:
+    log.info(f"-> %s => %s:%s by rsync"%(source_file, cx, final_file,))
+  else:
+    log.info(f"-> %s => %s:%s, %d bytes already there"%(source_file, cx, final_file, offset,))
+  archive_one(tx, the_file)
+  return rc
+
+def file_sum(a_file, algorithm="sha256"):
+  """
+  Return the checksum of a local file, None if it can't be read
+  """
+  hasher = hashlib.new(algorithm)
+  try:
+    with open(a_file, "rb") as source:
+      for chunk in iter(lambda: source.read(Options.chunk), b""):
+        hasher.update(chunk)
+  except OSError:
+    return None
+  return hasher.hexdigest()
+
+def dedup_one(cx, tx, the_file, size) -> bool:
+  """
+  Look for the content of a file among the ones delivered to the same
+  connection and target directory within tx["dedupwindow"] (or
+  Options.dedup_window) seconds. The index is searched by size and content
+  hashes are computed only when sizes match, for the stored copy too (from its
+  archived file) if it was not hashed yet.
+  Depending on tx["dedup"] a duplicate is skipped ('skip') or made remotely
+  from the delivered copy ('link' or 'copy', see dedup_local() for rows
+  without a remote transport), and archived as if it was sent
+  Returns True if the file was handled and needs no upload
+  """
+  global Options
+  source_file = os.path.join(tx[0], the_file)
+  final_file = target_name(tx, the_file)
+  db = state_db()
+  checksum = None
+  candidates = db.execute("SELECT rowid, hash, archived, remote FROM delivered WHERE cxname=? AND targetdir=? AND size=? AND ts>=?",
+    (cx, tx[1], size, time.time()-(tx["dedupwindow"] or Options.dedup_window),)).fetchall()
+  for rowid, delivered_sum, archived, remote_file in candidates:
+    if delivered_sum is None:             # Hash lazily, only on a size match
+      delivered_sum = file_sum(archived) if archived else None
+      if delivered_sum is None:
+        db.execute("DELETE FROM delivered WHERE rowid=?", (rowid,))
+        continue
+      db.execute("UPDATE delivered SET hash=? WHERE rowid=?", (delivered_sum, rowid,))
+    if checksum is None:
+      checksum = file_sum(source_file)
+      if checksum is None:
+        return False
+    if checksum!=delivered_sum or remote_file==final_file:
+      continue
+    if tx["dedup"] in ("link", "copy") and not transport_of(tx)["remote"]:
+      if not dedup_local(tx["dedup"], remote_file, final_file):
+        continue                          # Try another copy, or send it
+      log.info(f"-> %s => %s as a %s of '%s'"%(source_file, final_file, tx["dedup"], remote_file,))
+      dedup_record(cx, tx, the_file, size, checksum)
+    elif tx["dedup"] in ("link", "copy"):
+      if tx["dedup"]=="link":
+        remote_cmd = f"ln -f %s %s 2>/dev/null || cp -p %s %s"%(shlex.quote(remote_file), shlex.quote(final_file), shlex.quote(remote_file), shlex.quote(final_file),)
+      else:
+        remote_cmd = f"cp -p %s %s"%(shlex.quote(remote_file), shlex.quote(final_file),)
+      full_cmd = [ Options.ssh, cx, remote_cmd, ]
+      if Options.DEBUG:
+        log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+      try:
+        subprocess.run(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+      except (subprocess.CalledProcessError, OSError):
+        continue                          # Try another copy, or send it
+      log.info(f"-> %s => %s:%s as a %s of '%s'"%(source_file, cx, final_file, tx["dedup"], remote_file,))
+      dedup_record(cx, tx, the_file, size, checksum)
+    else:
+      log.info(f"-> %s skipped, same content as '%s:%s'"%(source_file, cx, remote_file,))
+    archive_one(tx, the_file)
+    return True
+  return False
+
+def dedup_local(mode, delivered_file, final_file) -> bool:
+  """
+  Make a duplicate in a locally mounted target directory from its
+  delivered copy, hard linked ('link', copied if it can't be) or copied
+  ('copy') under a temporary name and renamed into place
+  Returns True if the duplicate was made
+  """
+  temp_file = part_name(os.path.dirname(final_file), final_file)
+  try:
+    if os.path.lexists(temp_file):
+      os.unlink(temp_file)
+    linked = False
+    if mode=="link":
+      try:
+        os.link(delivered_file, temp_file)
+        linked = True
+      except OSError:                     # Another filesystem, copy it
+        pass
+    if not linked:
+      copy_kernel(delivered_file, temp_file)
+      st = os.stat(delivered_file)
+      os.utime(temp_file, ns=(st.st_atime_ns, st.st_mtime_ns,))
+    os.rename(temp_file, final_file)
+  except OSError as e:
+    log.error(f"Could not %s '%s' to '%s' e='%s'"%(mode, delivered_file, final_file, e,))
+    try:
+      os.unlink(temp_file)
+    except OSError:
+      pass
+    return False
+  return True
+
+def dedup_record(cx, tx, the_file, size, checksum=None):
+  """
+  Add a delivered file to the deduplication index, dedup_prune() trims it
+  once a cycle. The content hash is left for dedup_one() to compute if not
+  given
+  """
+  global Options
+  archived = os.path.join(tx[2], the_file) if tx[2] else None
+  if checksum is None and (archived is None or not os.path.isfile(archived)):
+    checksum = file_sum(os.path.join(tx[0], the_file))
+  db = state_db()
+  try:
+    db.execute("INSERT INTO delivered VALUES (?, ?, ?, ?, ?, ?, ?)",
+      (cx, tx[1], size, checksum, archived, target_name(tx, the_file), time.time(),))
+  except sqlite3.Error as e:
+    log.error(f"%s: Could not index '%s' e='%s'"%(Options.PrgName, the_file, e,))
+
+def dedup_prune(cx, txs):
   """
-  Return a log filename
+  Trim the deduplication index of the dedup tx rows of a connection to the
+  entries within their window, at most Options.dedup_max for each target
+  directory
   """
-  if cx:
-    log_file = os.path.join(os.getcwd(), os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]) + f".%s.log"%(cx[1],)
-  else:
-    log_file = os.path.join(os.getcwd(), os.path.splitext(os.path.basename(os.path.realpath(__file__)))[0]) + f".log"
-  return log_file
+  global Options
+  db = state_db()
+  for tx in txs:
+    if tx["dedup"]:
+      try:
+        db.execute("DELETE FROM delivered WHERE cxname=? AND targetdir=? AND (ts<? OR rowid IN "
+          "(SELECT rowid FROM delivered WHERE cxname=? AND targetdir=? ORDER BY ts DESC LIMIT -1 OFFSET ?))",
+          (cx, tx[1], time.time()-(tx["dedupwindow"] or Options.dedup_window), cx, tx[1], Options.dedup_max,))
+      except sqlite3.Error as e:
+        log.error(f"%s: Could not prune the deduplication index of '%s' e='%s'"%(Options.PrgName, tx["name"], e,))
 
-def set_logging(add_screen=True):
+def transmit_bundle(cx, tx, the_files):
   """
-  Configure logging
+  Transmit a cycle's files of a tx row as one tar stream over a single ssh
+  channel. The remote side unpacks them in a staging directory inside tx[1]
+  and renames each one into place, acknowledging it by name; only the
+  acknowledged files are archived
+  the_files has tuples (the_file, size)
+  Returns the number of files not acknowledged
   """
   global Options
-  if Options.dolog:
-    Options.log = logging.getLogger("INODO")
-    if Options.DEBUG:
-      Options.log.setLevel(logging.DEBUG)
+  target = shlex.quote(tx[1])
+  remote_cmd = (f'd=$(mktemp -d %s/.bundle.XXXXXX) || exit 1; '
+                f'if tar -xf - -C "$d"; then ls -A "$d" | while IFS= read -r f; do mv -f "$d/$f" %s/ && printf "%%s\\n" "$f"; done; fi; '
+                f'rm -rf "$d"'%(target, target,))
+  full_cmd = [ Options.ssh, cx, remote_cmd, ]
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  sent = []
+  try:
+    proc = subprocess.Popen(full_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+      with tarfile.open(fileobj=proc.stdin, mode="w|", format=tarfile.PAX_FORMAT) as bundle:
+        for the_file, size in the_files:
+          try:
+            bundle.add(os.path.join(tx[0], the_file), arcname=os.path.basename(the_file), recursive=False)
+            sent.append((the_file, size,))
+          except OSError as e:              # Gone or unreadable, next cycle
+            log.error(f"Could not bundle '%s' e='%s'"%(os.path.join(tx[0], the_file), e,))
+      proc.stdin.close()
+    except BrokenPipeError:
+      sent = []
+    acked = proc.stdout.read().decode("utf-8").splitlines()
+    rc = proc.wait()
+  except OSError as e:
+    log.error(f"%s: Could not run '%s' e='%s'"%(Options.PrgName, full_cmd, e,))
+    for the_file, size in the_files:
+      lease_failed(cx, "tx", os.path.join(tx[0], the_file))
+    return len(the_files)
+  if rc!=0:
+    log.info(f"---→ using '%s' returned %d"%(full_cmd, rc,))
+  log.info(f"-> bundle of %d files from %s => %s:%s, %d unpacked"%(len(sent), tx[0], cx, tx[1], len(acked),))
+  failed = 0
+  for the_file, size in the_files:
+    if (the_file, size,) in sent and os.path.basename(the_file) in acked:
+      archive_one(tx, the_file)
+      if tx["dedup"]:
+        dedup_record(cx, tx, the_file, size)
+      stat_add("tx", tx, True, size)
     else:
-      Options.log.setLevel(logging.INFO)
-    log_handler = logging.handlers.TimedRotatingFileHandler(Options.logfile,
-      when="M",        # Rotar mensualmente
-      interval=1,      # Logs de a 1 mes
-      backupCount=36,  # 36 meses o 3 años de logs
-    )
-    log_formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-    log_handler.setFormatter(log_formatter)
-    if add_screen:
-      screen_handler = logging.StreamHandler()
-      screen_formatter = logging.Formatter("%(levelname)s %(message)s")
-      screen_handler.setFormatter(screen_formatter)
-    # Clear handlers and re-add
-    # Clear
-    for a_handler in Options.log.handlers:
-      Options.log.removeHandler(a_handler)
-    # Re-add
-    Options.log.addHandler(log_handler)
-    if add_screen:
-      Options.log.addHandler(screen_handler)
-    return Options.log
+      stat_add("tx", tx, False)
+      lease_failed(cx, "tx", os.path.join(tx[0], the_file))
+      failed = failed + 1
+  return failed
 
-def transmit_one_scp(cx, tx, the_file):
+def fanout_targets(cx, tx) -> list:
   """
-  Try to transmit one file using SCP
-  cx       has the connection data. Must match something in $HOME/.ssh/config
-  tx       has the data for transmissions: local directory source, remote directory
-           target, local archive directory
-  the_file has the basename of the file to transmit
+  Return the (cxname, targetdir) a fan-out tx row delivers to: its own
+  connection and the ones in tx["fanout"], given as cxname or
+  cxname:targetdir separated by commas (tx[1] if no directory is given)
   """
-  cmd = Options.scp
-  source_file = os.path.join(tx[0], the_file)
-  full_cmd = f"%s %s %s:"%(cmd, source_file, cx, tx[1],)
-  rc = 0
-  if Options.DEBUG:
-    log.debug(f"---→ '%s'"%(full_cmd,))
-  try:                                      # Try to transmit
-    cx_lines = ""
-    cx_lines = subprocess.check_output(full_cmd.split(), shell=False)
-    cx_lines = cx_lines.decode('utf-8')
-    if Options.DEBUG and (len(cx_lines)>0):
-      log.debug(f"---→ %s"%(cx_lines,))
-      sys.stderr.flush()
-    if not Options.DEBUG:
-      log.info(f"-> %s => %s:%s"%(source_file, cx, tx[1],))
-  except subprocess.CalledProcessError as pe:
-    if pe.returncode!=0:
-      log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,))
-      rc = pe.returncode
-  try:                                      # Try to move
-    if Options.DEBUG:
-      log.debug(f"mv '%s' '%s'"%(source_file, os.path.join(tx[2], the_file),))
-    os.rename(source_file, os.path.join(tx[2], the_file)) # tx[2] == arch directory
-    if Options.DEBUG:
-      log.debug(f"'%s' moved"%(source_file,))
-  except:
-    log.error(f"Could not move '%s' to '%s'"%(source_file, tx[2],))
-  return rc
+  targets = [ (cx, tx[1],) ]
+  for a_target in (tx["fanout"] or "").split(","):
+    a_target = a_target.strip()
+    if a_target:
+      cxname, sep, targetdir = a_target.partition(":")
+      targets.append((cxname, targetdir or tx[1],))
+  return targets
 
-def transmit_one_sftp(cx, tx, the_file):
+def transmit_fanout(cx, tx, the_file) -> int:
   """
-  Try to transmit one file using SFTP
-  cx       has the connection data. Must match something in $HOME/.ssh/config
-  tx       has the data for transmissions: local directory source, remote directory
-           target, local archive directory
-  the_file has the basename of the file to transmit
+  Transmit one file to every target of a fan-out tx row, see fanout_send().
+  Targets that got the current version of the file are recorded and not
+  sent to again. The file is archived once tx["quorum"] targets (all if
+  NULL) have it; the targets still missing it are owed the archived copy,
+  see fanout_retry()
+  Returns rc, 0 if the file was archived
   """
-  cmd = Options.sftp
-  rc = 0
+  global Options
   source_file = os.path.join(tx[0], the_file)
-  temp = tempfile.NamedTemporaryFile(delete=False, dir=Options.tmpdir)
-  # temp = tempfile.NamedTemporaryFile(delete=False)
-  full_cmd = f"%s -b %s %s"%(cmd, temp.name, cx)
   try:
-    sftp_cmd = (f"put %s %s"%(source_file, tx[1],)).encode("utf-8")
+    st = os.stat(source_file)
+  except OSError as e:
+    log.error(f"Could not send '%s' e='%s'"%(source_file, e,))
+    return 1
+  version = f"%d:%d"%(st.st_size, int(st.st_mtime),)
+  db = state_db()
+  targets = fanout_targets(cx, tx)
+  done = set([ (cxname, targetdir,) for cxname, targetdir in db.execute("SELECT cxname, targetdir FROM fanout WHERE path=? AND version=?", (source_file, version,)) ])
+  for cxname, targetdir in fanout_send(tx, source_file, [ a_target for a_target in targets if a_target not in done ]):
+    done.add((cxname, targetdir,))
+    db.execute("INSERT INTO fanout VALUES (?, ?, ?, ?, ?)", (cxname, targetdir, source_file, version, time.time(),))
+  if len(done)<(tx["quorum"] or len(targets)):
+    log.info(f"---→ '%s' delivered to %d of %d targets, kept for the rest"%(source_file, len(done), len(targets),))
+    return 1
+  rc = archive_one(tx, the_file)
+  if rc!=0:
+    return rc
+  db.execute("DELETE FROM fanout WHERE path=?", (source_file,))
+  for cxname, targetdir in targets:
+    if (cxname, targetdir,) in done:
+      continue
+    if not tx[2]:
+      log.info(f"---→ '%s' not delivered to %s:%s, quorum reached"%(source_file, cxname, targetdir,))
+      continue
+    log.info(f"---→ '%s' not delivered to %s:%s yet, quorum reached, owed from the archive"%(source_file, cxname, targetdir,))
+    db.execute("INSERT OR REPLACE INTO fanout_owed VALUES (?, ?, ?, ?, 0, ?, ?)",
+      (tx["name"], cxname, targetdir, os.path.join(tx[2], the_file), time.time(), time.time(),))
+  return 0
+
+def fanout_send(tx, source_file, targets) -> set:
+  """
+  Send one file to fan-out targets (cxname, targetdir) of a tx row reading
+  it once: one ssh pipe per target, all fed from the same read (and codec)
+  Returns the targets that got it
+  """
+  global Options
+  a_name = os.path.basename(target_name(tx, source_file))
+  delivered = set()
+  procs = {}
+  for cxname, targetdir in targets:
+    if not cx_available(cxname):
+      continue
+    remote_file = part_name(targetdir, a_name)
+    remote_cmd = f"cat > %s"%(shlex.quote(remote_file),)
+    if not tx["checksum"] and not tx["compress"]:
+      remote_cmd = f"%s && mv -f %s %s"%(remote_cmd, shlex.quote(remote_file), shlex.quote(os.path.join(targetdir, a_name)),)
+    full_cmd = [ Options.ssh, cxname, remote_cmd, ]
     if Options.DEBUG:
-      log.debug(f"---> '%s'"%(sftp_cmd,))
-      log.debug(f"---→ '%s'"%(full_cmd,))
-    with open(temp.name, "wb") as tmpfile:
-      tmpfile.write(sftp_cmd)
-      tmpfile.close()
+      log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+    try:
+      procs[(cxname, targetdir,)] = subprocess.Popen(full_cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    except OSError as e:
+      log.error(f"%s: Could not run '%s' e='%s'"%(Options.PrgName, full_cmd, e,))
+  hasher = hashlib.new(tx["checksum"]) if tx["checksum"] else None
+  sent = 0
+  codec_rc = 0
+  if procs:
+    try:
+      with open(source_file, "rb") as source:
+        codec = None
+        if tx["compress"]:
+          codec = subprocess.Popen(codec_cmd(tx), stdin=source, stdout=subprocess.PIPE)
+          source = codec.stdout
+        for chunk in iter(lambda: source.read(Options.chunk), b""):
+          if hasher:
+            hasher.update(chunk)
+          sent = sent + len(chunk)
+          for a_target, proc in procs.items():
+            if not proc.stdin.closed:
+              try:
+                proc.stdin.write(chunk)
+              except BrokenPipeError:
+                proc.stdin.close()
+        if codec:
+          codec.stdout.close()
+          codec_rc = codec.wait()
+    except OSError as e:
+      log.error(f"Could not send '%s' e='%s'"%(source_file, e,))
+      codec_rc = 1
+  for (cxname, targetdir), proc in procs.items():
     try:
-      cx_lines = ""
-      cx_lines = subprocess.check_output(full_cmd.split(), shell=False)
-      cx_lines = cx_lines.decode('utf-8')
-      if Options.DEBUG and (len(cx_lines)>0):
-        log.debug(f"---→ %s"%(cx_lines,))
-        sys.stderr.flush()
-      if not Options.DEBUG:
-        sftp_cmd = sftp_cmd.decode("utf-8")
-        log.info(f"-> %s"%(sftp_cmd,))
-      try:                                      # Try to move
-        if Options.DEBUG:
-          log.debug(f"mv '%s' '%s'"%(source_file, os.path.join(tx[2], the_file),))
-        os.rename(source_file, os.path.join(tx[2], the_file)) # tx[2] == arch directory
-        log.info(f"'%s' moved to '%s'"%(source_file, os.path.join(tx[2], the_file),))
-        if Options.DEBUG:
-          log.debug(f"'%s' moved"%(source_file,))
-      except:
-        log.error(f"Could not move '%s' to '%s'"%(source_file, tx[2],))
+      proc.stdin.close()
+    except BrokenPipeError:
+      pass
+    rc = proc.wait() or codec_rc
+    remote_file = part_name(targetdir, a_name)
+    final_file = os.path.join(targetdir, a_name)
+    if rc==0 and hasher and not record_checksum(cxname, "tx", tx, final_file, sent, tx["checksum"], hasher.hexdigest(),
+        remote_sums(cxname, tx["checksum"], [ remote_file ]).get(remote_file)):
+      rc = 1
+    if rc==0 and (hasher or tx["compress"]):
+      rc = subprocess.call([ Options.ssh, cxname, f"mv -f %s %s"%(shlex.quote(remote_file), shlex.quote(final_file),), ],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    cx_record(cxname, rc)
+    if rc!=0:
+      log.info(f"---→ sending '%s' to %s:%s returned %d"%(source_file, cxname, targetdir, rc,))
+      continue
+    log.info(f"-> %s => %s:%s"%(source_file, cxname, final_file,))
+    delivered.add((cxname, targetdir,))
+  return delivered
+
+def fanout_retry(tx):
+  """
+  Send the archived files a fan-out tx row owes to the targets that missed
+  them when the quorum archived them, backing off like retry_record(). A
+  target still failing after --retry-max attempts is given up and logged
+  """
+  global Options
+  db = state_db()
+  now = time.time()
+  owed = db.execute("SELECT cxname, targetdir, archived, attempts FROM fanout_owed WHERE name=? AND nextat<=?", (tx["name"], now,)).fetchall()
+  archiving = set(Options.archiving.values())
+  for cxname, targetdir, archived, attempts in owed:
+    if archived in archiving or not cx_available(cxname):
+      continue                              # Archive copy still running, or target down
+    if not os.path.exists(archived):
+      log.error(f"%s: '%s' owed to %s:%s is gone from the archive"%(Options.PrgName, archived, cxname, targetdir,))
+    elif not fanout_send(tx, archived, [ (cxname, targetdir,) ]):
+      attempts = attempts + 1
+      if attempts<Options.retry_max:
+        db.execute("UPDATE fanout_owed SET attempts=?, nextat=? WHERE cxname=? AND targetdir=? AND archived=?",
+          (attempts, now + min(Options.retry_backoff*2**(attempts-1), Options.retry_max_backoff), cxname, targetdir, archived,))
+        continue
+      log.error(f"%s: '%s' failed %d times to %s:%s, given up"%(Options.PrgName, archived, attempts, cxname, targetdir,))
+    db.execute("DELETE FROM fanout_owed WHERE cxname=? AND targetdir=? AND archived=?", (cxname, targetdir, archived,))
+
+def scan_tx(cx, tx, now) -> list:
+  """
+  Return the queue items (priority, size, since, tx, name) of the files in
+  the source directory of a tx row that pass its filter and are not waiting
+  for a retry or for their archive copy. Files age from the first scan
+  they were seen in, not from their mtime, which copies may keep old
+  """
+  a_dir = tx[0]
+  if Options.DEBUG:
+    log.debug(f"Directory '%s'"%(a_dir,))
+  flt = Options.filters.get(("tx", tx["name"],))
+  seen = Options.seen.get(("tx", cx[1], tx["name"],), {})
+  listed = {}
+  items = []
+  for start_dir, dirs, files in os.walk(a_dir):
+    for one_file in files:
+      if not pass_filter(flt, name=one_file):
+        continue
       try:
-        os.unlink(temp.name)
-      except:
-        log.error(f"Could not remove temporary file '%s'"%(temp.name,))
-    except subprocess.CalledProcessError as pe:
-      if pe.returncode!=0:
-        log.info(f"---→ using '%s' in %s returned %d"%(full_cmd, temp.name, pe.returncode,))
-        rc = pe.returncode
-  except IOError as e:
-    print(f"A general IO error ocurred e='%s'"%(e,), file=sys.stderr)
-    if Options.DEBUG:
-      log.debug(f"Could not write temporary file '%s'"%(temp.name,))
-    else:
-      log.error(f"Could not write temporary file to directory '%s'"%(Options.tmpdir,))
-    rc =1
-  return rc
+        st = os.stat(os.path.join(start_dir, one_file))
+      except OSError:                       # Gone since the walk
+        continue
+      if not pass_filter(flt, size=st.st_size, age=now-st.st_mtime):
+        continue
+      source_file = os.path.join(tx[0], one_file) # As transmit, retry_record() and archive_one() name it
+      listed[source_file] = seen.get(source_file, now)
+      if retry_wait(cx[1], "tx", source_file, now):
+        continue
+      if source_file in Options.archiving:
+        continue                            # Sent, its archive copy is running
+      items.append((tx["priority"], st.st_size, listed[source_file], tx, one_file,))
+    if not files:
+      if Options.DEBUG:
+        log.debug(f"---→ '%s' found empty"%(start_dir,))
+  Options.seen[("tx", cx[1], tx["name"],)] = listed  # Forget the ones gone
+  return items
 
 def transmit_all(cx, txs):
   """
@@ -225,30 +1903,75 @@ def transmit_all(cx, txs):
   cx  has the connection data. Must match something in $HOME/.ssh/config
   txs has the list of settings for transmissions: source local directories,
       target remote directories, local archive directories
+  The files of all the txs are sent in the order given by schedule(), rows
+  out of their window or short of a batch are left for later
   """
   global Options
 
   if Options.DEBUG:
     log.debug(f"---→ Trying to transmit ...")
     log.debug(f"---→ cx='%s'"%(cx,))
-    log.debug(f"---→ txs='%s'"%(txs,))
+    log.debug(f"---→ txs='%s'"%([ dict(tx) for tx in txs ],))
+  phase("scan")
+  archive_reap()
+  items = []
   for tx in txs:
     if Options.DEBUG:
-      log.debug(f"---→ tx='%s'"%(tx,))
-    if os.path.isdir(tx[0]):
-      a_dir = tx[0]
+      log.debug(f"---→ tx='%s'"%(dict(tx),))
+    if not cx_available(cx[1]):
       if Options.DEBUG:
-        log.debug(f"Directory '%s'"%(a_dir,))
-      for start_dir, dirs, files in os.walk(a_dir):
-        for one_file in files:
-          if tx[3]==0:
-            # Transmit using SCP
-            transmit_one_scp(cx[1], tx, one_file)
-          else: # tx[3]==1
-            transmit_one_sftp(cx[1], tx, one_file)
-        else:
-          if Options.DEBUG:
-            log.debug(f"---→ '%s' found empty"%(a_dir,))
+        log.debug(f"---→ '%s' circuit open, skipping tx='%s'"%(cx[1], tx["name"],))
+      continue
+    if not in_window(Options.windows.get(("tx", tx["name"],))):
+      if Options.DEBUG:
+        log.debug(f"---→ tx='%s' out of its window"%(tx["name"],))
+      continue
+    if os.path.isdir(tx[0]):
+      now = time.time()
+      items.extend(batched(tx, scan_tx(cx, tx, now), now))
+  phase("transfer")
+  pending = {}                              # Work queued by each transport for its flush
+  for priority, size, since, tx, one_file in schedule(items):
+    if not cx_available(cx[1]):
+      log.info(f"---→ '%s' circuit open, leaving files for later"%(cx[1],))
+      break
+    item = f"tx:%s:%s"%(cx[1], os.path.join(tx[0], one_file),)
+    if Options.lease_db:
+      if not lease_claim(item):
+        continue
+      if not os.path.exists(os.path.join(tx[0], one_file)):
+        lease_done(item)                    # Sent by another node meanwhile
+        continue
+    if tx["dedup"] and dedup_one(cx[1], tx, one_file, size):
+      if Options.lease_db:
+        lease_done(item)
+      continue
+    transport = transport_of(tx)
+    started = time.time()
+    rc = transport["put"](cx, tx, one_file, size, pending.setdefault(transport["name"], []))
+    if rc!=QUEUED:
+      stat_add("tx", tx, rc==0, size, time.time()-started)
+    if rc!=QUEUED and transport["remote"]:
+      cx_record(cx[1], rc)
+    if rc!=QUEUED:
+      retry_record(cx[1], "tx", tx, os.path.join(tx[0], one_file), rc)
+    if Options.lease_db and rc!=QUEUED:
+      lease_done(item, rc==0)
+  for tx in txs:
+    if transport_of(tx)["name"]=="fanout" and in_window(Options.windows.get(("tx", tx["name"],))):
+      fanout_retry(tx)
+  for name, some_pending in pending.items():
+    if some_pending and TRANSPORTS[name]["flush_put"] and cx_available(cx[1]):
+      started = time.time()
+      cx_record(cx[1], TRANSPORTS[name]["flush_put"](cx, some_pending))
+      stat_flush("tx", some_pending, time.time()-started)
+    else:                                   # Not flushed, let any node retry
+      for a_pending in some_pending:
+        lease_failed(cx[1], "tx", os.path.join(a_pending[0][0], a_pending[1]))
+  dedup_prune(cx[1], txs)
+  if Options.lease_db:                      # Flushed ones are done too
+    for item in [ an_item for an_item in Options.leases if an_item.startswith(f"tx:%s:"%(cx[1],)) ]:
+      lease_done(item)
   return
 
 def receive_one_scp(cx, rx, a_file):
@@ -293,7 +2016,7 @@ def remove_one_scp(cx, rx, a_file):
       log.debug(f"-> %s"%(x_lines,))
   except subprocess.CalledProcessError as pe:
     if pe.returncode!=0:
-      log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,), file=sys.stderr)
+      log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,))
       rc = rc + pe.returncode
   return rc
 
@@ -302,43 +2025,13 @@ def receive_one_sftp(cx, rx, a_file):
   Receive a file using sftp
   """
   global Options
-  rc = 0
   if Options.DEBUG:
     log.debug(f"---→ cx='%s', rx='%s', a_file='%s'"%(cx, rx, a_file,))
-  temp = tempfile.NamedTemporaryFile(delete=False, dir=Options.tmpdir)
-  full_cmd = f"%s -b %s %s"%(Options.sftp, temp.name, cx[1],)
-  try:
-    sftp_cmd = (f"get %s %s"%(a_file, rx[1],)).encode("utf-8")
-    with open(temp.name, "wb") as tmpfile:
-      tmpfile.write(sftp_cmd)
-      tmpfile.close()
-    if Options.DEBUG:
-        log.debug(f"---→ sftp_cmd='%s'"%(sftp_cmd,))
-        log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
-    else:
-      sftp_cmd = sftp_cmd.decode("utf-8")
-      log.info(f"---→ %s"%(sftp_cmd,))
-    try:                  # Try to download one
-      rx_lines = ""
-      rx_lines = subprocess.check_output(full_cmd.split(), shell=False)
-      rx_lines = rx_lines.decode('utf-8')
-      if len(rx_lines)>0:
-        log.debug(f"-> %s"%(rx_lines,))
-    except subprocess.CalledProcessError as pe:
-      if pe.returncode!=0:
-        log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,), file=sys.stderr)
-        rc = rc + pe.returncode
-    try: # to remove temporary file
-      os.unlink(temp.name)
-    except:
-      log.error(f"Could not remove temporary file '%s'"%(temp.name,))
-  except IOError as e:
-    print(f"A general IO error ocurred e='%s'"%(e,), file=sys.stderr)
-    if Options.DEBUG:
-      log.debug(f"Could not write temporary file '%s'"%(temp.name,))
-    else:
-      log.error(f"Could not write temporary file to directory '%s'"%(Options.tmpdir,))
-    rc = rc + 1
+  sftp_cmd = f"get %s %s"%(sftp_quote(a_file), sftp_quote(rx[1]),)
+  log.info(f"---→ %s"%(sftp_cmd,))
+  rc = sftp_run(cx[1], [ sftp_cmd ])
+  if rc!=0:
+    log.info(f"---→ using '%s' on %s returned %d"%(sftp_cmd, cx[1], rc,))
   return rc
 
 def remove_one_sftp(cx, rx, a_file):
@@ -346,127 +2039,740 @@ def remove_one_sftp(cx, rx, a_file):
   Remove a file using sftp
   """
   global Options
-  rc = 0
   if Options.DEBUG:
     log.debug(f"---→ cx='%s', rx='%s', a_file='%s'"%(cx, rx, a_file,))
-  temp = tempfile.NamedTemporaryFile(delete=False, dir=Options.tmpdir)
-  full_cmd = f"%s -b %s %s"%(Options.sftp, temp.name, cx[1],)
+  sftp_cmd = f"rm %s"%(sftp_quote(a_file),)
+  log.info(f"---→ %s"%(sftp_cmd,))
+  rc = sftp_run(cx[1], [ sftp_cmd ])
+  if rc!=0:
+    log.info(f"---→ using '%s' on %s returned %d"%(sftp_cmd, cx[1], rc,))
+  return rc
+
+def stream_lines(full_cmd):
+  """
+  Run a listing command and yield its output lines as they arrive, so a
+  huge listing is never held in memory. Closing the generator early kills
+  the command; a command failing raises subprocess.CalledProcessError once
+  its lines were consumed
+  """
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  proc = subprocess.Popen(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+  finished = False
+  try:
+    for a_line in proc.stdout:
+      yield a_line.decode("utf-8", "replace").rstrip("\n")
+    finished = True
+  finally:
+    if not finished:
+      proc.kill()             # Stopped before the end of the listing
+    proc.stdout.close()
+    rc = proc.wait()
+  if rc!=0:
+    log.info(f"---→ using '%s' returned %d"%(full_cmd, rc,))
+    raise subprocess.CalledProcessError(rc, full_cmd)
+
+def parse_ls_long(ls_lines):
+  """
+  Yield the (name, size) of the regular files in 'ls -l' output lines
+  """
+  for a_line in ls_lines:
+    fields = a_line.split(None, 8)
+    if len(fields)==9 and fields[0].startswith("-"):
+      try:
+        yield (fields[8], int(fields[4]),)
+      except ValueError:
+        pass
+
+def list_one_scp(cx, rx):
+  """
+  List the files in a remote directory using ssh and a remote find, which
+  streams the directory unsorted. When the row filters, the globs and
+  limits are given to find so filtered files are not listed; find ages
+  files in minutes, so minage is rounded up to the next minute
+  Yields (name, size), names relative to rx[0]
+  """
+  global Options
+
+  flt = Options.filters.get(("rx", rx["name"],))
+  conds = []
+  if flt is not None:
+    if flt["include_globs"]:
+      conds.append(f"\\( %s \\)"%(" -o ".join([ f"-name %s"%(shlex.quote(a_glob),) for a_glob in flt["include_globs"] ]),))
+    for a_glob in flt["exclude_globs"]:
+      conds.append(f"! -name %s"%(shlex.quote(a_glob),))
+    if flt["minsize"]:
+      conds.append(f"-size +%dc"%(flt["minsize"]-1,))
+    if flt["maxsize"]:
+      conds.append(f"-size -%dc"%(flt["maxsize"]+1,))
+    if flt["minage"]:                       # Whole minutes, rounded up: never younger than minage
+      conds.append(f"-mmin +%d"%((flt["minage"]+59)//60,))
+  full_cmd = [ Options.ssh, cx[1], f"cd %s && find . ! -name . -prune -type f %s -exec ls -ln {{}} +"%(shlex.quote(rx[0]), " ".join(conds),), ]
+  if Options.DEBUG:
+    log.debug(f"---→ rx='%s'"%(dict(rx),))
+  for a_file, size in parse_ls_long(stream_lines(full_cmd)):
+    yield (a_file[2:] if a_file.startswith("./") else a_file, size,)
+
+def list_one_sftp(cx, rx):
+  """
+  List the files in a remote directory using sftp, unsorted, in the
+  listing session of the connection so the names stream in while they
+  are transferred. When the row includes only globs, one ls per glob lists
+  just the matching files (a glob matching nothing is not an error)
+  Yields (name, size), names include the rx[0] path: servers that don't
+  map ids print their long names, bare file names, in a directory listing
+  """
+  global Options
+
+  flt = Options.filters.get(("rx", rx["name"],))
+  if flt and flt["include_globs"]:
+    sftp_cmds = [ f"ls -lf %s/%s"%(sftp_quote(rx[0].rstrip("/") or "/"), sftp_glob(a_glob),) for a_glob in flt["include_globs"] ]
+  else:
+    sftp_cmds = [ f"ls -lf %s"%(sftp_quote(rx[0]),) ]
+  prefix = rx[0].rstrip("/") + "/"
+  for a_file, size in parse_ls_long(sftp_lines(cx[1], sftp_cmds, check=not (flt and flt["include_globs"]), session="ls")):
+    yield (a_file if a_file.startswith(prefix) else os.path.join(rx[0], a_file), size,)
+
+def remote_name(rx, a_file) -> str:
+  """
+  Return the remote path of a listed file: sftp listings include rx[0]
+  """
+  return a_file if transport_of(rx)["ls_paths"] else os.path.join(rx[0], a_file)
+
+def receive_one_stream(cx, rx, a_file):
+  """
+  Receive one file through an ssh pipe, computing its checksum with the
+  algorithm in rx["checksum"] while it is written. Rows that compress pipe
+  it through their codec to decompress it, checksum and size are the ones
+  of the remote file. The local copy keeps a temporary name until
+  verify_downloads() checks it, without checksum it is renamed as soon as
+  it is complete
+  Returns (rc, checksum, size)
+  """
+  global Options
+  rc = 0
+  local_file = part_name(rx[1], a_file)
+  full_cmd = [ Options.ssh, cx[1], f"cat %s"%(shlex.quote(remote_name(rx, a_file)),), ]
+  hasher = hashlib.new(rx["checksum"]) if rx["checksum"] else None
+  size = 0
+  if Options.DEBUG:
+    log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+  try:
+    with open(local_file, "wb") as target:
+      codec = None
+      if rx["compress"]:
+        codec = subprocess.Popen(codec_cmd(rx, decompress=True), stdin=subprocess.PIPE, stdout=target)
+        target = codec.stdin
+      proc = subprocess.Popen(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+      try:
+        for chunk in iter(lambda: proc.stdout.read(Options.chunk), b""):
+          if hasher:
+            hasher.update(chunk)
+          size = size + len(chunk)
+          target.write(chunk)
+      except BrokenPipeError:
+        proc.kill()
+      rc = proc.wait()
+      if codec:
+        codec.stdin.close()
+        if codec.wait()!=0 and rc==0:
+          log.error(f"Could not decompress '%s:%s' using '%s'"%(cx[1], remote_name(rx, a_file), codec_cmd(rx, decompress=True),))
+          rc = 1
+    if rc==0 and not hasher:
+      os.rename(local_file, target_name(rx, a_file))
+  except OSError as e:
+    log.error(f"Could not receive '%s' e='%s'"%(local_file, e,))
+    rc = 1
+  if rc!=0:
+    log.info(f"---→ using '%s' returned %d"%(full_cmd, rc,))
+    try:
+      os.unlink(local_file)
+    except OSError:
+      pass
+    return (rc, None, size,)
+  log.info(f"<- %s:%s => %s"%(cx[1], remote_name(rx, a_file), local_file if hasher else rx[1],))
+  return (rc, hasher.hexdigest() if hasher else None, size,)
+
+def sync_filesystem(fd) -> bool:
+  """
+  syncfs() the filesystem holding fd, returns False where libc lacks it
+  """
+  global Options
+  if Options.syncfs is None:
+    try:
+      Options.syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+      Options.syncfs = False
+  if not Options.syncfs:
+    return False
+  if Options.syncfs(fd)!=0:
+    an_errno = ctypes.get_errno()
+    raise OSError(an_errno, os.strerror(an_errno))
+  return True
+
+def receive_done(cx, rx, a_file):
+  """
+  Remove the remote copy of a received file. Durable rx rows hold it in the
+  running group instead, removed by commit_group() once the local copy is
+  on disk
+  """
+  global Options
+  if rx["durable"]:
+    Options.uncommitted.append((rx, a_file,))
+    if len(Options.uncommitted)>=Options.sync_group:
+      commit_group(cx)
+    return
+  running = phase("archive")
+  try:
+    transport_of(rx)["rm"](cx, rx, a_file)
+  finally:
+    phase(running)
+
+def commit_group(cx):
+  """
+  Commit the group of files received by durable rx rows: one syncfs() of
+  each target filesystem (an fsync() of each file where syncfs() is missing)
+  and one fsync() of each target directory, then the remote copies are
+  removed, with one command by row where the transport runs over ssh.
+  If syncing fails the remote copies are kept and received again
+  """
+  global Options
+  group = Options.uncommitted
+  Options.uncommitted = []
+  if not group:
+    return
+  running = phase("archive")
   try:
-    sftp_cmd = (f"rm %s"%(a_file,)).encode("utf-8")
-    with open(temp.name, "wb") as tmpfile:
-      tmpfile.write(sftp_cmd)
-      tmpfile.close()
+    by_directory = {}
+    for rx, a_file in group:
+      by_directory.setdefault(rx[1], []).append(target_name(rx, a_file))
+    synced = set()                          # Filesystems already synced
+    try:
+      for directory, local_files in by_directory.items():
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+          device = os.fstat(fd).st_dev
+          if device not in synced:
+            if sync_filesystem(fd):
+              synced.add(device)
+            else:
+              for local_file in local_files:
+                try:
+                  with open(local_file, "rb") as a_copy:
+                    os.fsync(a_copy.fileno())
+                except FileNotFoundError:   # Already taken by its consumer
+                  pass
+          os.fsync(fd)
+        finally:
+          os.close(fd)
+    except OSError as e:
+      log.error(f"%s: Could not sync %d received files, keeping their remote copies e='%s'"%(Options.PrgName, len(group), e,))
+      return
     if Options.DEBUG:
-        log.debug(f"---→ sftp_cmd='%s'"%(sftp_cmd,))
-        log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+      log.debug(f"---→ committed %d files in %d directories"%(len(group), len(by_directory),))
+    by_row = {}
+    for rx, a_file in group:
+      by_row.setdefault(rx["name"], (rx, [],))[1].append(a_file)
+    for rx, a_files in by_row.values():
+      transport = transport_of(rx)
+      if transport["name"] in ("scp", "ssh", "bundle"):
+        remote_remove(cx[1], [ remote_name(rx, a_file) for a_file in a_files ])
+      else:
+        for a_file in a_files:
+          transport["rm"](cx, rx, a_file)
+  finally:
+    phase(running)
+
+def verify_downloads(cx, downloads):
+  """
+  Check the streamed downloads of a cycle against the remote files with one
+  batched remote hashing command. Good copies get their final name and the
+  remote file is removed; bad copies are removed and received again later
+  downloads has tuples (rx, a_file, checksum, size)
+  Returns the number of files that could not be verified
+  """
+  failed = 0
+  by_algorithm = {}
+  for a_download in downloads:
+    by_algorithm.setdefault(a_download[0]["checksum"], []).append(a_download)
+  for algorithm, some_downloads in by_algorithm.items():
+    sums = remote_sums(cx[1], algorithm, [ remote_name(rx, a_file) for rx, a_file, checksum, size in some_downloads ])
+    for rx, a_file, checksum, size in some_downloads:
+      local_file = part_name(rx[1], a_file)
+      final_file = target_name(rx, a_file)
+      try:
+        if not record_checksum(cx[1], "rx", rx, final_file, size, algorithm, checksum, sums.get(remote_name(rx, a_file))):
+          os.unlink(local_file)
+          stat_add("rx", rx, False)
+          retry_record(cx[1], "rx", rx, remote_name(rx, a_file), 1)
+          lease_failed(cx[1], "rx", remote_name(rx, a_file))
+          failed = failed + 1
+          continue
+        os.rename(local_file, final_file)
+      except OSError as e:
+        log.error(f"Could not move '%s' to '%s' e='%s'"%(local_file, final_file, e,))
+        stat_add("rx", rx, False)
+        lease_failed(cx[1], "rx", remote_name(rx, a_file))
+        failed = failed + 1
+        continue
+      stat_add("rx", rx, True, size)
+      retry_record(cx[1], "rx", rx, remote_name(rx, a_file), 0)
+      receive_done(cx, rx, a_file)
+  return failed
+
+def receive_bundle(cx, rx, a_files):
+  """
+  Receive remote files of an rx row as tar streams, one ssh channel for as
+  many files as fit in a command line. Files are unpacked in a staging
+  directory inside rx[1] and renamed into place once the whole stream
+  arrived; only then the remote files are removed, with one command
+  Returns the number of files not received
+  """
+  global Options
+  failed = 0
+  by_name = {}
+  for a_file in a_files:
+    by_name[os.path.basename(remote_name(rx, a_file))] = a_file
+  quoted = { shlex.quote(a_name): a_name for a_name in by_name }
+  for batch in arg_batches(list(quoted)):
+    full_cmd = [ Options.ssh, cx[1], f"tar -cf - -C %s -- %s"%(shlex.quote(rx[0]), " ".join(batch),), ]
+    if Options.DEBUG:
+      log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
+    staging = None
+    received = []
+    sizes = {}
+    try:
+      staging = tempfile.mkdtemp(prefix=".bundle.", dir=rx[1])
+      proc = subprocess.Popen(full_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+      with tarfile.open(fileobj=proc.stdout, mode="r|") as bundle:
+        for member in bundle:
+          a_name = os.path.basename(member.name)
+          if not member.isfile() or a_name not in by_name:
+            continue
+          with bundle.extractfile(member) as source, open(os.path.join(staging, a_name), "wb") as target:
+            for chunk in iter(lambda: source.read(Options.chunk), b""):
+              target.write(chunk)
+          received.append(a_name)
+          sizes[a_name] = member.size
+      rc = proc.wait()
+    except (OSError, tarfile.TarError) as e:
+      log.error(f"%s: Could not receive bundle from '%s' e='%s'"%(Options.PrgName, rx[0], e,))
+      rc = 1
+    if rc==0:
+      for a_name in received:
+        os.rename(os.path.join(staging, a_name), os.path.join(rx[1], a_name))
+      log.info(f"<- bundle of %d files from %s:%s => %s"%(len(received), cx[1], rx[0], rx[1],))
+      if rx["durable"]:
+        for a_name in received:
+          receive_done(cx, rx, by_name[a_name])
+      else:
+        remote_remove(cx[1], [ remote_name(rx, by_name[a_name]) for a_name in received ])
     else:
-      sftp_cmd = sftp_cmd.decode("utf-8")
-      log.info(f"---→ %s"%(sftp_cmd,))
-    try:                  # Try to remove one
-      rx_lines = ""
-      rx_lines = subprocess.check_output(full_cmd.split(), shell=False)
-      rx_lines = rx_lines.decode('utf-8')
-      if len(rx_lines)>0:
-        log.debug(f"-> %s"%(rx_lines,))
-    except subprocess.CalledProcessError as pe:
-      if pe.returncode!=0:
-        log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,), file=sys.stderr)
-        rc = rc + pe.returncode
-    try: # to remove temporary file
-      os.unlink(temp.name)
-    except:
-      log.error(f"Could not remove temporary file '%s'"%(temp.name,))
-  except IOError as e:
-    print(f"A general IO error ocurred e='%s'"%(e,), file=sys.stderr)
+      log.info(f"---→ using '%s' returned %d"%(full_cmd, rc,))
+      received = []
+    for a_name in received:
+      stat_add("rx", rx, True, sizes[a_name])
+    for a_name in [ quoted[a_quoted] for a_quoted in batch ]:
+      if a_name not in received:
+        stat_add("rx", rx, False)
+        lease_failed(cx[1], "rx", remote_name(rx, by_name[a_name]))
+    failed = failed + len(batch) - len(received)
+    if staging:
+      for a_name in os.listdir(staging):
+        os.unlink(os.path.join(staging, a_name))
+      os.rmdir(staging)
+  return failed
+
+def copy_kernel(source_file, target_file):
+  """
+  Copy a file letting the kernel move the data: copy_file_range, else
+  sendfile, else a plain read/write loop
+  """
+  with open(source_file, "rb") as source, open(target_file, "wb") as target:
+    size = os.fstat(source.fileno()).st_size
+    copied = 0
+    try:
+      while copied<size:
+        n = os.copy_file_range(source.fileno(), target.fileno(), size-copied)
+        if n==0:
+          break
+        copied = copied + n
+    except (AttributeError, OSError) as e:
+      if isinstance(e, OSError) and e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        raise
+      try:
+        while copied<size:
+          n = os.sendfile(target.fileno(), source.fileno(), copied, size-copied)
+          if n==0:
+            break
+          copied = copied + n
+      except (AttributeError, OSError):
+        source.seek(copied)
+        target.seek(copied)
+        for chunk in iter(lambda: source.read(Options.chunk), b""):
+          target.write(chunk)
+
+def copy_hashing(source_file, target_file, algorithm) -> str:
+  """
+  Copy a file computing its checksum on the way. Returns the checksum
+  """
+  hasher = hashlib.new(algorithm)
+  with open(source_file, "rb") as source, open(target_file, "wb") as target:
+    for chunk in iter(lambda: source.read(Options.chunk), b""):
+      hasher.update(chunk)
+      target.write(chunk)
+  return hasher.hexdigest()
+
+def copy_local(cx, direction, row, source_file, target_dir, keep_source=True) -> int:
+  """
+  Copy a file into a local directory (a mount, for the local transport)
+  under a temporary name and rename it into place. On the same filesystem
+  the file is renamed (keep_source=False) or hard linked, else the kernel
+  copies it. With a checksum the copy is hashed and checked instead
+  Returns rc
+  """
+  final_file = os.path.join(target_dir, os.path.basename(source_file))
+  temp_file = part_name(target_dir, source_file)
+  try:
+    if row["checksum"]:
+      checksum = copy_hashing(source_file, temp_file, row["checksum"])
+      if not record_checksum(cx, direction, row, final_file, os.path.getsize(temp_file), row["checksum"], checksum, file_sum(temp_file, row["checksum"])):
+        os.unlink(temp_file)
+        return 1
+    elif not keep_source:
+      try:
+        os.rename(source_file, final_file)
+        return 0
+      except OSError as e:
+        if e.errno!=errno.EXDEV:
+          raise
+        copy_kernel(source_file, temp_file)
+    else:
+      try:
+        if os.path.lexists(temp_file):
+          os.unlink(temp_file)
+        os.link(source_file, temp_file)
+      except OSError:
+        copy_kernel(source_file, temp_file)
+    os.rename(temp_file, final_file)
+  except OSError as e:
+    log.error(f"Could not copy '%s' to '%s' e='%s'"%(source_file, final_file, e,))
+    try:
+      os.unlink(temp_file)
+    except OSError:
+      pass
+    return 1
+  return 0
+
+def transmit_one_local(cx, tx, the_file) -> int:
+  """
+  Transmit one file to a locally mounted target directory and archive it
+  """
+  source_file = os.path.join(tx[0], the_file)
+  rc = copy_local(cx, "tx", tx, source_file, tx[1], keep_source=bool(tx[2]))
+  if rc==0:
+    log.info(f"-> %s => %s"%(source_file, tx[1],))
+    if tx[2] and os.path.exists(source_file):
+      archive_one(tx, the_file)
+    elif os.path.exists(source_file):   # Copied, nowhere to archive
+      os.unlink(source_file)
+  return rc
+
+def receive_one_local(cx, rx, a_file) -> int:
+  """
+  Receive one file from a locally mounted source directory
+  """
+  source_file = os.path.join(rx[0], a_file)
+  rc = copy_local(cx[1], "rx", rx, source_file, rx[1])
+  if rc==0:
+    log.info(f"<- %s => %s"%(source_file, rx[1],))
+  return rc
+
+def remove_one_local(cx, rx, a_file) -> int:
+  """
+  Remove a received file from a locally mounted source directory
+  """
+  try:
+    os.unlink(os.path.join(rx[0], a_file))
+  except OSError as e:
+    log.error(f"Could not remove '%s' e='%s'"%(os.path.join(rx[0], a_file), e,))
+    return 1
+  return 0
+
+def list_one_local(cx, rx):
+  """
+  List the files in a locally mounted source directory, applying the whole
+  filter of the row
+  Yields (name, size), names relative to rx[0]
+  """
+  flt = Options.filters.get(("rx", rx["name"],))
+  now = time.time()
+  try:
+    with os.scandir(rx[0]) as it:
+      for an_entry in it:
+        if not an_entry.is_file(follow_symlinks=False) or not pass_filter(flt, name=an_entry.name):
+          continue
+        st = an_entry.stat()
+        if pass_filter(flt, size=st.st_size, age=now-st.st_mtime):
+          yield (an_entry.name, st.st_size,)
+  except OSError as e:
+    log.error(f"Could not list '%s' e='%s'"%(rx[0], e,))
+    raise
+
+def put_one(transmit_one, cx, tx, the_file, size) -> int:
+  """
+  Transmit one file with a transmit_one_*() function that archives it, and
+  index it for deduplication
+  """
+  rc = transmit_one(cx[1], tx, the_file)
+  if rc==0 and tx["dedup"]:
+    dedup_record(cx[1], tx, the_file, size)
+  return rc
+
+def put_ssh(cx, tx, the_file, size, pending) -> int:
+  """
+  Transmit one file through an ssh pipe. With a checksum the file waits in
+  pending for verify_uploads() at the end of the cycle
+  """
+  rc, checksum, sent = transmit_one_stream(cx[1], tx, the_file)
+  if rc==0 and tx["checksum"]:
+    pending.append((tx, the_file, checksum, sent, size,))
+    return QUEUED
+  if rc==0:
+    archive_one(tx, the_file)
+    if tx["dedup"]:
+      dedup_record(cx[1], tx, the_file, size)
+  return rc
+
+def get_ssh(cx, rx, a_file, size, pending) -> int:
+  """
+  Receive one file through an ssh pipe. With a checksum the file waits in
+  pending for verify_downloads() at the end of the cycle
+  """
+  rc, checksum, received = receive_one_stream(cx, rx, a_file)
+  if rc==0 and rx["checksum"]:
+    pending.append((rx, a_file, checksum, received,))
+    return QUEUED
+  return rc
+
+def flush_bundles_put(cx, pending) -> int:
+  """
+  Transmit the files queued by bundle tx rows, one tar stream per row
+  """
+  bundles = {}
+  for tx, the_file, size in pending:
+    bundles.setdefault(tx["name"], (tx, [],))[1].append((the_file, size,))
+  return sum([ transmit_bundle(cx[1], tx, the_files) for tx, the_files in bundles.values() ])
+
+def flush_bundles_get(cx, pending) -> int:
+  """
+  Receive the files queued by bundle rx rows, as tar streams by row
+  """
+  bundles = {}
+  for rx, a_file in pending:
+    bundles.setdefault(rx["name"], (rx, [],))[1].append(a_file)
+  return sum([ receive_bundle(cx, rx, a_files) for rx, a_files in bundles.values() ])
+
+# Transports tx and rx rows dispatch through, selected by name in their
+# transport column. Each one can
+#   put(cx, tx, the_file, size, pending)   send and archive one file, or queue it
+#                                          in pending and return QUEUED
+#   flush_put(cx, pending)                 send what put() queued in the cycle
+#   ls(cx, rx)                             list a source directory yielding (name, size)
+#   get(cx, rx, a_file, size, pending)     receive one file, or queue it
+#   rm(cx, rx, a_file)                     remove a received file
+#   flush_get(cx, pending)                 receive and remove what get() queued
+# fanout and delta only send. ls_paths tells if listed names include rx[0], ls_age if ls checked minage,
+# remote if failures count for the connection health and verifies if it checks the checksum of a row
+TRANSPORTS = {
+  "scp": { "name": "scp", "remote": True, "ls_paths": False, "ls_age": True, "verifies": False,
+    "put": lambda cx, tx, the_file, size, pending: put_one(transmit_one_scp, cx, tx, the_file, size),
+    "flush_put": None, "ls": list_one_scp,
+    "get": lambda cx, rx, a_file, size, pending: receive_one_scp(cx, rx, a_file),
+    "rm": remove_one_scp, "flush_get": None, },
+  "sftp": { "name": "sftp", "remote": True, "ls_paths": True, "ls_age": False, "verifies": False,
+    "put": lambda cx, tx, the_file, size, pending: put_one(transmit_one_sftp, cx, tx, the_file, size),
+    "flush_put": None, "ls": list_one_sftp,
+    "get": lambda cx, rx, a_file, size, pending: receive_one_sftp(cx, rx, a_file),
+    "rm": remove_one_sftp, "flush_get": None, },
+  "ssh": { "name": "ssh", "remote": True, "ls_paths": False, "ls_age": True, "verifies": True,
+    "put": put_ssh,
+    "flush_put": lambda cx, pending: verify_uploads(cx[1], pending),
+    "ls": list_one_scp, "get": get_ssh,
+    "rm": lambda cx, rx, a_file: remote_remove(cx[1], [ remote_name(rx, a_file) ]),
+    "flush_get": verify_downloads, },
+  "bundle": { "name": "bundle", "remote": True, "ls_paths": False, "ls_age": True, "verifies": False,
+    "put": lambda cx, tx, the_file, size, pending: pending.append((tx, the_file, size,)) or QUEUED,
+    "flush_put": flush_bundles_put, "ls": list_one_scp,
+    "get": lambda cx, rx, a_file, size, pending: pending.append((rx, a_file,)) or QUEUED,
+    "rm": lambda cx, rx, a_file: remote_remove(cx[1], [ remote_name(rx, a_file) ]),
+    "flush_get": flush_bundles_get, },
+  "fanout": { "name": "fanout", "remote": False, "ls_paths": False, "ls_age": True, "verifies": True,
+    "put": lambda cx, tx, the_file, size, pending: transmit_fanout(cx[1], tx, the_file),
+    "flush_put": None, "ls": None, "get": None, "rm": None, "flush_get": None, },
+  "delta": { "name": "delta", "remote": True, "ls_paths": False, "ls_age": True, "verifies": True,
+    "put": lambda cx, tx, the_file, size, pending: put_one(transmit_one_delta, cx, tx, the_file, size),
+    "flush_put": None, "ls": None, "get": None, "rm": None, "flush_get": None, },
+  "local": { "name": "local", "remote": False, "ls_paths": False, "ls_age": True, "verifies": True,
+    "put": lambda cx, tx, the_file, size, pending: put_one(transmit_one_local, cx, tx, the_file, size),
+    "flush_put": None, "ls": list_one_local,
+    "get": lambda cx, rx, a_file, size, pending: receive_one_local(cx, rx, a_file),
+    "rm": remove_one_local, "flush_get": None, },
+}
+
+def transport_of(row) -> dict:
+  """
+  Return the transport of a tx/rx row: the one named in its transport
+  column, else the one its fanout, bundle, compress, checksum and sftp
+  columns imply
+  """
+  fanout = "fanout" in row.keys() and row["fanout"]
+  delta = "delta" in row.keys() and row["delta"]
+  if row["transport"]:
+    name = row["transport"]
+  elif fanout:
+    name = "fanout"
+  elif delta:
+    name = "delta"
+  elif row["bundle"]:
+    name = "bundle"
+  elif row["checksum"] or row["compress"]:
+    name = "ssh"
+  else:
+    name = "sftp" if row["sftp"] else "scp"
+  if name not in TRANSPORTS:
+    raise ValueError(f"unknown transport '%s' in '%s'"%(name, row["name"],))
+  if row["checksum"] and row["checksum"] not in CHECKSUMS:
+    raise ValueError(f"checksum '%s' in '%s' is not one of %s"%(row["checksum"], row["name"], ", ".join(CHECKSUMS),))
+  if row["checksum"] and (not TRANSPORTS[name]["verifies"] or delta=="rsync"):
+    raise ValueError(f"checksum in '%s' needs a transport that verifies it: ssh, fanout, delta append or local"%(row["name"],))
+  if row["compress"] and (row["compress"] not in CODECS or name not in ("ssh", "fanout")):
+    raise ValueError(f"compress '%s' in '%s' needs a known codec and the ssh or fanout transport"%(row["compress"], row["name"],))
+  if (name=="fanout")!=bool(fanout) or (fanout and row["dedup"]):
+    raise ValueError(f"fanout in '%s' needs the fanout transport of a tx row, without dedup"%(row["name"],))
+  if (name=="delta")!=bool(delta) or (delta and (delta not in ("append", "rsync") or row["compress"])):
+    raise ValueError(f"delta '%s' in '%s' needs append or rsync and the delta transport of a tx row, without compress"%(delta, row["name"],))
+  return TRANSPORTS[name]
+
+def list_all(cx, rx, now):
+  """
+  Yield the queue items (priority, size, since, rx, name) of the remote
+  files of an rx row while its listing streams in, up to --max-names names
+  per cycle; the rest stays for the next cycle. Listing failures are
+  accounted and the listing just ends, the row is left in
+  Options.list_failed for this cycle
+  """
+  global Options
+  transport = transport_of(rx)
+  Options.list_failed.discard((cx[1], rx["name"],))
+  seen = Options.seen.get(("rx", cx[1], rx["name"],), {})
+  listed = {}
+  flt = Options.filters.get(("rx", rx["name"],))
+  entries = transport["ls"](cx, rx)
+  try:
+    for a_file, size in entries:
+      listed[a_file] = seen.get(a_file, now)
+      # find already checked the age; sftp listings age from the first listing
+      if pass_filter(flt, a_file, size, None if transport["ls_age"] else now-listed[a_file]) and not retry_wait(cx[1], "rx", remote_name(rx, a_file), now):
+        yield (rx["priority"], size, listed[a_file], rx, a_file,)
+      if Options.max_names and len(listed)>=Options.max_names:
+        log.info(f"---→ %s:%s listing stopped after %d names"%(cx[1], rx[0], len(listed),))
+        entries.close()
+        break
+  except (subprocess.CalledProcessError, OSError) as e:
+    Options.list_failed.add((cx[1], rx["name"],))
+    stat_add("rx", rx, False)
+    if transport["remote"]:
+      cx_record(cx[1], e.returncode if isinstance(e, subprocess.CalledProcessError) else 1)
+    return
+  if not listed:
     if Options.DEBUG:
-      log.debug(f"Could not write temporary file '%s'"%(temp.name,))
+      log.debug(f"---→ %s found empty."%(rx[0],))
+  Options.seen[("rx", cx[1], rx["name"],)] = listed  # Forget the ones gone
+
+def receive_window(cx, items):
+  """
+  Receive a window of queued remote files in the order given by schedule(),
+  then flush what the transports deferred
+  """
+  global Options
+  rc = 0
+  pending = {}                              # Work queued by each transport for its flush
+  for priority, size, since, rx, a_file in schedule(items):
+    if not cx_available(cx[1]):
+      log.info(f"---→ '%s' circuit open, leaving files for later"%(cx[1],))
+      break
+    item = f"rx:%s:%s"%(cx[1], remote_name(rx, a_file),)
+    if Options.lease_db and not lease_claim(item):
+      continue
+    transport = transport_of(rx)
+    started = time.time()
+    rorc = transport["get"](cx, rx, a_file, size, pending.setdefault(transport["name"], []))
+    if rorc==QUEUED:
+      continue
+    stat_add("rx", rx, rorc==0, size, time.time()-started)
+    if transport["remote"]:
+      cx_record(cx[1], rorc)
+    retry_record(cx[1], "rx", rx, remote_name(rx, a_file), rorc)
+    if rorc==0:
+      receive_done(cx, rx, a_file)
     else:
-      log.error(f"Could not write temporary file to directory '%s'"%(Options.tmpdir,))
-    rc = rc + 1
+      rc = rc + rorc
+    if Options.lease_db:
+      lease_done(item, rorc==0)
+  for name, some_pending in pending.items():
+    if some_pending and TRANSPORTS[name]["flush_get"] and cx_available(cx[1]):
+      started = time.time()
+      rorc = TRANSPORTS[name]["flush_get"](cx, some_pending)
+      stat_flush("rx", some_pending, time.time()-started)
+      cx_record(cx[1], rorc)
+      rc = rc + rorc
+    else:                                   # Not flushed, let any node retry
+      for a_pending in some_pending:
+        lease_failed(cx[1], "rx", remote_name(a_pending[0], a_pending[1]))
+  commit_group(cx)
+  if Options.lease_db:                      # Flushed ones are done too
+    for item in [ an_item for an_item in Options.leases if an_item.startswith(f"rx:%s:"%(cx[1],)) ]:
+      lease_done(item)
   return rc
 
 def receive_all(cx, rxs):
   """
   Do a reception set
+  Listings are read as they stream in and received in windows of
+  --in-flight files, each in the order given by schedule(), their age
+  counted from the first cycle they were listed in. A listing shorter than
+  a window is scheduled together with the rows listed after it. Rows out of
+  their schedule window or short of a batch are left for later
   """
   global Options
   rc = 0
-  
-  def desanida_lista(lista_lista):
-    return [item for sublist in lista_lista for item in sublist]
 
   if Options.DEBUG:
     print(f"---→ Trying to receive ...", file=sys.stderr)
     print(f"---→ cx='%s'"%(cx,), file=sys.stderr)
+  items = []
+  now = time.time()
   for rx in rxs:
-    if rx[2]==0: # receive by SCP
-      cmd = [ Options.ssh, cx[1], "ls", ]
-      full_cmd = list(cmd)
-      full_cmd.append(rx[0])
+    if not cx_available(cx[1]):
       if Options.DEBUG:
-        log.debug(f"---→ rx='%s'"%(rx,))
-        log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
-      try:                   # Try to list
-        rx_lines = ""
-        rx_lines = subprocess.check_output(full_cmd, shell=False)
-        rx_lines = rx_lines.decode('utf-8')
-        if len(rx_lines)>0:
-          rx_lines = rx_lines.splitlines()
-          if Options.DEBUG:
-            log.debug(f"<- %s"%(rx_lines,))
-            sys.stderr.flush()
-          for a_file in rx_lines:
-            rorc = receive_one(cx, rx, a_file)
-            if rorc==0:
-              remove_one(cx, rx, a_file)
-        else:
-          if Options.DEBUG:
-            log.debug(f"---→ %s found empty."%(rx[0],))
-      except subprocess.CalledProcessError as pe:
-        if pe.returncode!=0:
-          log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,))
-          rc = rc + pe.returncode
-    else: # receive by SFTP
-      temp = tempfile.NamedTemporaryFile(delete=False, dir=Options.tmpdir)
-      full_cmd = f"%s -b %s %s"%(Options.sftp, temp.name, cx[1],)
-      try:
-        sftp_cmd = (f"ls %s"%(rx[0])).encode("utf-8")
-        if Options.DEBUG:
-          log.debug(f"---→ full_cmd='%s'"%(full_cmd,))
-          log.debug(f"---→ sftp_cmd='%s'"%(sftp_cmd,))
-        with open(temp.name, "wb") as tmpfile:
-          tmpfile.write(sftp_cmd)
-          tmpfile.close()
-        try:
-          cx_lines = ""
-          cx_lines = subprocess.check_output(full_cmd.split(), shell=False)
-          cx_lines = cx_lines.decode('utf-8')
-          if len(cx_lines)>0:
-            source_lines = cx_lines.splitlines()[1:]
-            source_files = []
-            for a_source_line in source_lines:
-              source_files.append(a_source_line.split())
-            source_files = desanida_lista(source_files)
-            if Options.DEBUG:
-              log.debug(f"<--- %s"%(cx_lines,))
-            for a_source in source_files:
-              if receive_one_sftp(cx, rx, a_source)==0:
-                remove_one_sftp(cx, rx, a_source)
-        except subprocess.CalledProcessError as pe:
-          if pe.returncode!=0:
-            log.info(f"---→ using '%s' returned %d"%(full_cmd, pe.returncode,))
-            rc = rc + pe.returncode
-        try: # to remove temporary file
-          os.unlink(temp.name)
-        except:
-          log.error(f"%s: Could not remove temporary file '%s'"%(Options.PrgName, temp.name,))
-      except IOError as e:
-        print(f"A general IO error ocurred e='%s'"%(e,), file=sys.stderr)
-        if Options.DEBUG:
-          log.debug(f"Could not write temporary file '%s'"%(temp.name,))
-        else:
-          log.error(f"Could not write temporary file to directory '%s'"%(Options.tmpdir,))
-        rc = rc + 1
+        log.debug(f"---→ '%s' circuit open, skipping rx='%s'"%(cx[1], rx["name"],))
+      continue
+    if not in_window(Options.windows.get(("rx", rx["name"],)), now):
+      if Options.DEBUG:
+        log.debug(f"---→ rx='%s' out of its window"%(rx["name"],))
+      continue
+    phase("listing")
+    for an_item in batched(rx, list_all(cx, rx, now), now):
+      items.append(an_item)
+      if len(items)>=Options.in_flight:
+        phase("transfer")
+        rc = rc + receive_window(cx, items)
+        items = []
+        phase("listing")
+  phase("transfer")
+  if items:
+    rc = rc + receive_window(cx, items)
   return rc
 
 # START OF MAIN FILE
@@ -475,18 +2781,86 @@ try:
   parser.add_option("--verbose", "-v", dest="verbose", action="store_true", help="Verbose mode", default=False)
   parser.add_option("--seconds", "--segundos", dest="seconds", action="store_true", help="Run with a period of seconds", default=False)
   parser.add_option("-w", "--wait", "--espera", dest="wait", action="store", help="Wait time units", type="int", default=5)
-  parser.add_option("-C", "--cx", "--connection", dest="connection", action="store", help="Connection filter to use", default=None)
+  parser.add_option("-1", "--once", dest="once", action="store_true", help="Run one cycle, print a summary and exit: 0 ok, 5 partial, 6 failed, 7 already running", default=False)
+  parser.add_option("--plan", dest="plan", action="store_true", help="Scan and list without transferring, estimating from the recorded throughput whether each row fits the -w interval, without writing the configuration database: 0 all fit, 8 some miss it or could not be listed", default=False)
+  parser.add_option("--lock", dest="lock", action="store", help="Lock file of --once runs, defaults to the log file name with .lock", default=None)
+  parser.add_option("-C", "--cx", "--connection", dest="connection", action="store", help="Connection filter to use, several can be given separated by commas", default=None)
   parser.add_option("--scp-bin", "--scp", dest="scp", action="store", help=SUPPRESS_HELP, default="/usr/bin/scp")
   parser.add_option("--sftp-bin", "--sftp", dest="sftp", action="store", help=SUPPRESS_HELP, default="/usr/bin/sftp")
   parser.add_option("--ssh-bin", "--ssh", dest="ssh", action="store", help=SUPPRESS_HELP, default="/usr/bin/ssh")
+  parser.add_option("--rsync-bin", "--rsync", dest="rsync", action="store", help=SUPPRESS_HELP, default="/usr/bin/rsync")
+  parser.add_option("--gzip-bin", "--gzip", dest="gzip", action="store", help=SUPPRESS_HELP, default="gzip")
+  parser.add_option("--zstd-bin", "--zstd", dest="zstd", action="store", help=SUPPRESS_HELP, default="zstd")
   parser.add_option("--dont-move", dest="move", action="store_false", help=SUPPRESS_HELP, default=True)
   parser.add_option("--no-log", "--dont-log", dest="dolog", action="store_false", help="Don't log to a file", default=True)
   parser.add_option("-o", "--output", dest="logfile", action="store", type="string", help="Log execution into file name")
   parser.add_option("--tmp", dest="tmp", action="store", type="string", help="Temporary directory, defaults to /tmp", default="/tmp")
+  parser.add_option("--order", dest="order", action="store", type="choice", choices=["smallest", "largest", "fifo"], help="Order of files with the same priority: smallest, largest or fifo", default="smallest")
+  parser.add_option("--aging", dest="aging", action="store", type="int", help="Seconds waiting that raise a file one priority level, 0 disables", default=600)
+  parser.add_option("--max-wait", dest="max_wait", action="store", type="int", help="Seconds after which a file goes before all others, 0 disables", default=3600)
+  parser.add_option("--hash-cmd", dest="hash_cmd", action="store", help="Remote command to hash files, %s is the checksum algorithm", default="%ssum")
+  parser.add_option("--keep-days", dest="keep_days", action="store", type="int", help="Days checksum records are kept", default=30)
+  parser.add_option("--dedup-window", dest="dedup_window", action="store", type="int", help="Seconds a delivered content is remembered for deduplication, unless set in the tx row", default=86400)
+  parser.add_option("--dedup-max", dest="dedup_max", action="store", type="int", help="Delivered files remembered for deduplication by connection and target directory", default=10000)
+  parser.add_option("--delta-block", dest="delta_block", action="store", type="int", help="Bytes compared at each end of a remote copy to detect appended files", default=64*1024)
+  parser.add_option("--chunk", dest="chunk", action="store", type="int", help=SUPPRESS_HELP, default=256*1024)
+  parser.add_option("--max-args", dest="max_args", action="store", type="int", help=SUPPRESS_HELP, default=64*1024)
+  parser.add_option("--in-flight", dest="in_flight", action="store", type="int", help="Listed remote files scheduled and received together", default=1000)
+  parser.add_option("--max-names", dest="max_names", action="store", type="int", help="Remote names read per rx row and cycle, 0 for no limit", default=100000)
+  parser.add_option("--sync-group", dest="sync_group", action="store", type="int", help="Files received by durable rx rows synced to disk together before their remote copies are removed", default=256)
+  parser.add_option("--retry-backoff", dest="retry_backoff", action="store", type="int", help="Seconds a failed file waits before its next try, doubled on each attempt", default=60)
+  parser.add_option("--retry-max-backoff", dest="retry_max_backoff", action="store", type="int", help="Maximum seconds a failed file waits", default=6*3600)
+  parser.add_option("--retry-max", dest="retry_max", action="store", type="int", help="Attempts after which a failing file is quarantined", default=10)
+  parser.add_option("--quarantine", dest="quarantine", action="store", help="Directory quarantined tx files are moved to, unless set in the tx row", default=None)
+  parser.add_option("--lease-db", dest="lease_db", action="store", help="Shared SQLite database where nodes serving the same connections claim files", default=None)
+  parser.add_option("--lease", dest="lease", action="store", type="int", help="Seconds a claimed file stays leased unless renewed", default=600)
+  parser.add_option("--node", dest="node", action="store", help="Node name in the lease database, defaults to host:pid", default=None)
+  parser.add_option("-t", "--probe-timeout", dest="probe_timeout", action="store", type="int", help="SSH connection timeout of health probes", default=10)
+  parser.add_option("-T", "--auth-timeout", dest="auth_timeout", action="store", type="int", help="SSH authentication timeout of health probes", default=5)
+  parser.add_option("--probe-cache", dest="probe_cache", action="store", type="int", help="Seconds a probe result is reused", default=60)
+  parser.add_option("--failures", dest="failures", action="store", type="int", help="Consecutive failures before probing a connection", default=3)
+  parser.add_option("--backoff", dest="backoff", action="store", type="int", help="Seconds an unreachable connection is skipped, doubled each time", default=60)
+  parser.add_option("--max-backoff", dest="max_backoff", action="store", type="int", help="Maximum seconds an unreachable connection is skipped", default=3600)
+  parser.add_option("--profile", dest="profile", action="store", type="int", help="Profile the first N cycles into a .prof file next to the log file", default=0)
+  parser.add_option("--timing-cycles", dest="timing_cycles", action="store", type="int", help="Cycles kept in the phase timing histograms reported at exit and on SIGUSR1", default=1000)
   parser.add_option("--DEBUG", dest="DEBUG", action="store_true", help=SUPPRESS_HELP, default=False)
 
   (Options, Args) = parser.parse_args()
   Options.PrgName = "Davitrans"
+  Options.health = {}
+  Options.stats = {}      # Files, bytes and time by (tx|rx, row name)
+  Options.recorded = {}   # Options.stats when last recorded, see throughput_record()
+  Options.seen = {}       # First time each file was listed, by (tx|rx, cx, row name)
+  Options.filters = {}    # Compiled filters by (tx|rx, row name)
+  Options.windows = {}    # Compiled schedule windows by (tx|rx, row name)
+  Options.phase = ("scan", time.time(),)  # Running phase of the cycle and its start
+  Options.cycle = {}      # Seconds by phase in the running cycle
+  Options.timings = {}    # Seconds by phase in the last cycles, see cycle_done()
+  Options.cycles = 0
+  Options.profiler = None
+  if Options.profile:
+    Options.profiler = cProfile.Profile()
+    Options.profiler.enable()
+  log = None
+  atexit.register(shutdown_report)
+  signal.signal(signal.SIGUSR1, report_timings)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128+signum))
+  Options.statedb = None  # State tables connection, see state_db()
+  Options.list_failed = set() # (cxname, rx name) whose last listing failed, see list_all()
+  Options.pruned_at = 0.0
+  Options.retries = None  # Failed files, see retry_table()
+  Options.leasedb = None  # Lease database connection, see lease_db()
+  Options.sftps = {}      # sftp process of each connection, see sftp_session()
+  Options.sftp_mark = 0
+  Options.uncommitted = []  # Received by durable rx rows, see commit_group()
+  Options.syncfs = None
+  Options.archiving = {}  # Target of each file queued for archiver()
+  Options.archive_queue = None
+  Options.archived = queue.Queue()
+  Options.leases = set()  # Items this node holds and renews
+  Options.lease_lock = threading.Lock()
+  if not Options.node:
+    Options.node = f"%s:%d"%(socket.gethostname(), os.getpid(),)
 
   if Options.DEBUG:
     Options.verbose = False
@@ -515,6 +2889,7 @@ try:
     sys.exit(1)
   else:
     confdb = Args[0]
+    Options.confdb = confdb
     log.info(f"%s: starting execution"%(Options.PrgName,))
     log.info(f"%s: configuration file '%s'"%(Options.PrgName, confdb,))
     log.info(f"%s: will check for files to transmit each %d %s"%(Options.PrgName, Options.wait, "seconds" if Options.seconds else "minutes",))
@@ -524,16 +2899,38 @@ try:
     if not os.path.isfile(confdb):
       log.critical(f"%s: Could not use '%s', exiting..."%(Options.PrgName, confdb,))
       sys.exit(3)
-    conf = load_all_conf(confdb)
+    confs = [ load_all_conf(confdb, a_connection) for a_connection in Options.connection.split(",") ]
+    confs = [ conf for conf in confs if conf and conf[0] ]
     if Options.DEBUG:
-      log.debug(f"%s: conf='%s'"%(Options.PrgName, conf,))
+      log.debug(f"%s: confs='%s'"%(Options.PrgName, confs,))
+    if not confs:
+      log.critical(f"%s: No connection matches '%s', exiting..."%(Options.PrgName, Options.connection,))
+      sys.exit(4)
     # Re-set logging
-    Options.logfile = log_filename(conf[0])
+    Options.logfile = log_filename((None, "+".join([ conf[0][1] for conf in confs ]),))
     log.info(f"%s changing to new log file '%s'"%(Options.PrgName, Options.logfile,))
     log = None
     log = set_logging(add_screen=False)
     log.info(f"%s changed to new log file '%s'"%(Options.PrgName, Options.logfile,))
-    
+    if Options.plan:
+      sys.exit(plan_cycle(confs))
+
+    if Options.once:
+      lock_file = Options.lock or os.path.splitext(Options.logfile)[0] + ".lock"
+      Options.lockfile = run_lock(lock_file)
+      if Options.lockfile is None:
+        log.info(f"%s: '%s' held by another run, skipping"%(Options.PrgName, lock_file,))
+        sys.exit(7)
+      archive_resume([ tx for conf in confs for tx in conf[1] ])
+      for conf in confs:
+        transmit_all(conf[0], conf[1])
+        receive_all(conf[0], conf[2])
+      archive_reap(wait=True)
+      throughput_record(confs)
+      cycle_done()
+      sys.exit(report_stats())
+
+    archive_resume([ tx for conf in confs for tx in conf[1] ])
     wait = Options.wait if Options.seconds else 60*Options.wait
     if Options.DEBUG:
       unit = "s" if Options.seconds else "m"
@@ -542,9 +2939,14 @@ try:
       if Options.DEBUG:
         print("\n")
       print(f"%s"%(datetime.now(),))
-      transmit_all(conf[0], conf[1])
-      receive_all(conf[0], conf[2])
+      phase("scan")
+      for conf in confs:   # An open circuit skips only its own connection
+        transmit_all(conf[0], conf[1])
+        receive_all(conf[0], conf[2])
+      throughput_record(confs)
+      phase("sleep")
       sleep(wait)
+      cycle_done()
 except KeyboardInterrupt:
   log.critical(f"%s: Process cancelled!"%(Options.PrgName,))
   sys.stderr.flush()
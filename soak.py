@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+soak.py: corre davitrans durante horas contra un sustituto local de ssh/scp/sftp
+  y mide la latencia de cada archivo de punta a punta, la memoria, los descriptores
+  y los temporales abandonados, fallando si se pasan los umbrales dados.
+
+Files dropped in the tx source directory count as delivered once they are whole
+in the "remote" target directory; files dropped in the "remote" rx source
+directory once they are whole in the rx target directory and gone remotely
+Exit status: 0 within thresholds, 1 some threshold exceeded, 2 could not run
+"""
+
+from datetime import datetime
+from optparse import OptionParser, SUPPRESS_HELP
+from time import sleep
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Stand-ins for ssh, scp and sftp running everything locally, host names ignored
+STAND_INS = {
+  "ssh": '''
+import os, sys
+a = sys.argv[1:]
+while a and a[0].startswith("-"):
+  a = a[2:] if a[0] in ("-o", "-p", "-i", "-l", "-F") else a[1:]
+os.execvp("sh", [ "sh", "-c", " ".join(a[1:]) or "exit 0", ])
+''',
+  "scp": '''
+import os, shutil, sys
+a = [ an_arg for an_arg in sys.argv[1:] if not an_arg.startswith("-") ]
+source, target = [ a_path.split(":", 1)[1] if ":" in a_path else a_path for a_path in a[-2:] ]
+try:
+  if os.path.isdir(target):
+    target = os.path.join(target, os.path.basename(source))
+  shutil.copyfile(source, target)
+except OSError as e:
+  sys.stderr.write("scp: %s\\n"%(e,))
+  sys.exit(1)
+''',
+  "sftp": '''
+import glob, os, shutil, subprocess, sys, time
+def sftp_words(line):
+  # Split like sftp does: quoted or escaped wildcards are literal characters
+  # Returns [ pattern, literal path, has wildcards ] for each word
+  words = []
+  word = None
+  quote = None
+  i = 0
+  while i<len(line):
+    c = line[i]
+    if quote is None and c in " \\t":
+      if word is not None:
+        words.append(word)
+        word = None
+      i = i + 1
+      continue
+    if word is None:
+      word = [ "", "", False, ]
+    if quote is None and c in "\\"'":
+      quote = c
+    elif c==quote:
+      quote = None
+    elif c=="\\\\" and i+1<len(line):
+      i = i + 1
+      word[0] = word[0] + glob.escape(line[i])
+      word[1] = word[1] + line[i]
+    else:
+      word[0] = word[0] + (c if quote is None else glob.escape(c))
+      word[1] = word[1] + c
+      word[2] = word[2] or (quote is None and c in "*?[")
+    i = i + 1
+  if word is not None:
+    words.append(word)
+  return words
+a = sys.argv[1:]
+batch = None
+while a and a[0].startswith("-"):
+  if a[0]=="-b":
+    batch = a[1]
+  a = a[2:] if a[0] in ("-b", "-o", "-P", "-i", "-F") else a[1:]
+source = sys.stdin if batch in ("-", None) else open(batch)
+for line in source:
+  line = line.strip()
+  if not line:
+    continue
+  ignore = line.startswith("-")
+  cmd = line.lstrip("-")
+  sys.stdout.write("sftp> %s\\n"%(cmd,))
+  sys.stdout.flush()
+  if cmd.startswith("!"):
+    subprocess.call(cmd[1:], shell=True)
+    continue
+  try:
+    words = sftp_words(cmd)
+    paths = [ a_word[1] for a_word in words ]
+    if paths[0] in ("put", "get"):
+      target = paths[2] if len(paths)>2 else "."
+      if os.path.isdir(target):
+        target = os.path.join(target, os.path.basename(paths[1]))
+      shutil.copyfile(paths[1], target)
+    elif paths[0]=="rm":
+      os.unlink(paths[1])
+    elif paths[0]=="rename":
+      os.rename(paths[1], paths[2])
+    elif paths[0]=="ls":
+      long = any([ a_path.startswith("-") and "l" in a_path for a_path in paths[1:] ])
+      for pattern, a_path, wild in [ a_word for a_word in words[1:] if not a_word[1].startswith("-") ] or [ [ ".", ".", False, ], ]:
+        if not wild and os.path.isdir(a_path):
+          # Long listings of a directory print the server's long names,
+          # bare file names on servers that don't map user and group ids
+          names = [ (a_name, os.path.join(a_path, a_name),) for a_name in sorted(os.listdir(a_path)) ]
+        elif wild and glob.glob(pattern):
+          names = [ (a_name, a_name,) for a_name in sorted(glob.glob(pattern)) ]
+        elif not wild and os.path.exists(a_path):
+          names = [ (a_path, a_path,) ]
+        else:
+          raise OSError("Can't ls: \\"%s\\" not found"%(a_path,))
+        for a_name, full_name in names:
+          if long:
+            st = os.stat(full_name)
+            sys.stdout.write("-rw-r--r--    1 user     group    %8d %s %s\\n"%(st.st_size, time.strftime("%b %d %H:%M", time.localtime(st.st_mtime)), a_name,))
+          else:
+            sys.stdout.write(full_name + "\\n")
+    else:
+      raise OSError("Invalid command.")
+  except (OSError, IndexError, ValueError) as e:
+    sys.stderr.write("%s\\n"%(e,))
+    sys.stderr.flush()
+    if not ignore and batch is not None:
+      sys.exit(1)
+  sys.stdout.flush()
+''',
+}
+
+SIZE_UNITS = { "": 1, "K": 1024, "M": 1024**2, "G": 1024**3, }
+
+def parse_sizes(sizes) -> list:
+  """
+  Parse a comma separated list of size:weight, sizes with optional K, M or G
+  Returns a list of (bytes, weight)
+  """
+  parsed = []
+  for a_size in sizes.split(","):
+    size, weight = (a_size.strip().split(":") + [ "1", ])[:2]
+    unit = size[-1:].upper() if size[-1:].upper() in SIZE_UNITS else ""
+    parsed.append((int(float(size[:len(size)-len(unit)])*SIZE_UNITS[unit]), float(weight),))
+  return parsed
+
+def percentile(values, fraction) -> float:
+  """
+  Return the fraction percentile of a sorted list, 0.0 if empty
+  """
+  if not values:
+    return 0.0
+  return values[min(len(values)-1, int(fraction*len(values)))]
+
+def make_sandbox(work):
+  """
+  Create the directories, stand-ins and configuration database of a soak run
+  Returns a dict of the paths
+  """
+  paths = { a_dir: os.path.join(work, a_dir) for a_dir in ("src", "arch", "remote_in", "remote_out", "tgt", "tmp", "stage", "bin",) }
+  for a_dir in paths.values():
+    os.makedirs(a_dir, exist_ok=True)
+  for name, code in STAND_INS.items():
+    paths[name] = os.path.join(paths["bin"], name)
+    with open(paths[name], "w") as stand_in:
+      stand_in.write(f"#!%s\n%s"%(sys.executable, code,))
+    os.chmod(paths[name], 0o755)
+  paths["confdb"] = os.path.join(work, "conf.db")
+  if os.path.exists(paths["confdb"]):
+    os.unlink(paths["confdb"])
+  with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "conf.sql")) as schema:
+    conf = sqlite3.connect(paths["confdb"])
+    conf.executescript(schema.read())
+  sftp = 1 if Options.transport=="sftp" else 0
+  conf.execute("INSERT INTO cxdef VALUES (1, 'soak')")
+  conf.execute("INSERT INTO tx (id, name, sourcedir, cxid, targetdir, archivedir, sftp, transport, checksum) VALUES (1, 'soak-tx', ?, 1, ?, ?, ?, ?, ?)",
+    (paths["src"], paths["remote_in"], paths["arch"], sftp, Options.transport, Options.checksum,))
+  conf.execute("INSERT INTO rx (id, name, sourcedir, cxid, targetdir, sftp, transport, checksum) VALUES (1, 'soak-rx', ?, 1, ?, ?, ?, ?)",
+    (paths["remote_out"], paths["tgt"], sftp, Options.transport, Options.checksum,))
+  conf.commit()
+  conf.close()
+  return paths
+
+def arrivals(paths, until):
+  """
+  Drop files until the given time: a steady trickle of --trickle files a
+  minute with exponential gaps, plus --burst files every --burst-every
+  seconds, sizes drawn from --sizes. Files are written in a staging
+  directory and renamed into place, their drop time recorded in
+  Options.dropped
+  """
+  global Options
+  directions = [ "tx", "rx", ] if Options.direction=="both" else [ Options.direction, ]
+  drop_dirs = { "tx": paths["src"], "rx": paths["remote_out"], }
+  sizes = parse_sizes(Options.sizes)
+  block = os.urandom(1024*1024)
+  now = time.time()
+  next_trickle = now + (random.expovariate(Options.trickle/60.0) if Options.trickle else until)
+  next_burst = now + (Options.burst_every if Options.burst else until)
+  sequence = 0
+  while not Options.stopping.is_set() and time.time()<until:
+    now = time.time()
+    count = 0
+    if now>=next_trickle:
+      count = count + 1
+      next_trickle = now + random.expovariate(Options.trickle/60.0)
+    if now>=next_burst:
+      count = count + Options.burst
+      next_burst = now + Options.burst_every
+    for a_drop in range(count):
+      sequence = sequence + 1
+      direction = random.choice(directions)
+      size = random.choices([ a_size for a_size, weight in sizes ], [ weight for a_size, weight in sizes ])[0]
+      name = f"soak-%s-%08d.dat"%(direction, sequence,)
+      staged = os.path.join(paths["stage"], name)
+      with open(staged, "wb") as a_file:
+        left = size
+        while left>0:
+          left = left - a_file.write(block[:min(left, len(block))])
+      os.rename(staged, os.path.join(drop_dirs[direction], name))
+      with Options.lock:
+        Options.dropped[(direction, name,)] = (time.time(), size,)
+    sleep(min(0.05, max(0.0, min(next_trickle, next_burst)-time.time())))
+
+def collect(paths, now):
+  """
+  Record the latency of the files delivered since the last sample and
+  remove them, as the partner and local consumers would
+  """
+  global Options
+  with Options.lock:
+    waiting = dict(Options.dropped)
+  for direction, a_dir in (("tx", paths["remote_in"],), ("rx", paths["tgt"],),):
+    for an_entry in os.scandir(a_dir):
+      dropped = waiting.get((direction, an_entry.name,))
+      if dropped is None:
+        continue
+      try:
+        if an_entry.stat().st_size!=dropped[1]:
+          continue                          # Still being written
+      except FileNotFoundError:
+        continue
+      if direction=="rx" and os.path.exists(os.path.join(paths["remote_out"], an_entry.name)):
+        continue                            # Not removed remotely yet
+      Options.latencies[direction].append(now-dropped[0])
+      Options.latency_file.write(f"%.3f,%s,%s,%d,%.3f\n"%(now, direction, an_entry.name, dropped[1], now-dropped[0],))
+      with Options.lock:
+        del Options.dropped[(direction, an_entry.name,)]
+      os.unlink(an_entry.path)
+  for an_entry in os.scandir(paths["arch"]):
+    if not an_entry.name.startswith("."):
+      os.unlink(an_entry.path)
+
+def temp_files(paths, now) -> list:
+  """
+  Return the ages of the temporary files davitrans left: anything in its
+  --tmp directory and part or bundle staging names in the directories it
+  writes into
+  """
+  ages = []
+  for a_dir in (paths["tmp"], paths["tgt"], paths["remote_in"], paths["arch"],):
+    for an_entry in os.scandir(a_dir):
+      if a_dir==paths["tmp"] or an_entry.name.startswith("."):
+        try:
+          ages.append(now-an_entry.stat(follow_symlinks=False).st_mtime)
+        except FileNotFoundError:
+          pass
+  return ages
+
+def process_usage(pid):
+  """
+  Return the resident memory in MB and open file descriptors of a process,
+  (None, None) if it is gone
+  """
+  try:
+    with open(f"/proc/%d/status"%(pid,)) as status:
+      rss = [ int(a_line.split()[1]) for a_line in status if a_line.startswith("VmRSS:") ][0]/1024.0
+    return rss, len(os.listdir(f"/proc/%d/fd"%(pid,)))
+  except (OSError, IndexError):
+    return None, None
+
+def report(final=False):
+  """
+  Print the latency percentiles by direction and the resource figures so far
+  """
+  lines = []
+  for direction in ("tx", "rx",):
+    values = sorted(Options.latencies[direction])
+    lines.append(f"%s %d delivered p50 %.1fs p95 %.1fs p99 %.1fs max %.1fs"%(direction, len(values),
+      percentile(values, 0.50), percentile(values, 0.95), percentile(values, 0.99), values[-1] if values else 0.0,))
+  with Options.lock:
+    waiting = len(Options.dropped)
+  lines.append(f"waiting %d rss %.1fMB (max %.1fMB) fds %d (max %d) temp files %d (max %d)"%(waiting,
+    Options.rss[-1] if Options.rss else 0.0, max(Options.rss or [ 0.0, ]), Options.fds[-1] if Options.fds else 0,
+    max(Options.fds or [ 0, ]), Options.temps, Options.max_temps,))
+  print(f"%s %s%s"%(datetime.now(), "final " if final else "", " | ".join(lines),))
+  sys.stdout.flush()
+
+def check_slos(leaked, rc) -> list:
+  """
+  Return the thresholds the run exceeded, as messages
+  """
+  failures = []
+  if rc not in (0, 128+signal.SIGTERM, -signal.SIGTERM):
+    failures.append(f"davitrans exited with %s"%(rc,))
+  for direction in ("tx", "rx",):
+    values = sorted(Options.latencies[direction])
+    for name, fraction, limit in (("p50", 0.50, Options.max_p50,), ("p95", 0.95, Options.max_p95,),
+                                  ("p99", 0.99, Options.max_p99,), ("max", 1.0, Options.max_latency,),):
+      if limit and percentile(values, fraction)>limit:
+        failures.append(f"%s latency %s %.1fs over %.1fs"%(direction, name, percentile(values, fraction), limit,))
+  with Options.lock:
+    waiting = len(Options.dropped)
+  if waiting>Options.max_undelivered:
+    failures.append(f"%d files not delivered after draining"%(waiting,))
+  if Options.max_rss and Options.rss and max(Options.rss)>Options.max_rss:
+    failures.append(f"rss %.1fMB over %.1fMB"%(max(Options.rss), Options.max_rss,))
+  if Options.max_rss_growth and Options.rss_base is not None and Options.rss:
+    growth = Options.rss[-1] - Options.rss_base
+    if growth>Options.max_rss_growth:
+      failures.append(f"rss grew %.1fMB after warm-up, over %.1fMB"%(growth, Options.max_rss_growth,))
+  if Options.max_fds and Options.fds and max(Options.fds)>Options.max_fds:
+    failures.append(f"%d open descriptors over %d"%(max(Options.fds), Options.max_fds,))
+  if Options.max_fd_growth and Options.fds_base is not None and Options.fds:
+    if Options.fds[-1]-Options.fds_base>Options.max_fd_growth:
+      failures.append(f"open descriptors grew by %d after warm-up, over %d"%(Options.fds[-1]-Options.fds_base, Options.max_fd_growth,))
+  if leaked>Options.max_leaked:
+    failures.append(f"%d temporary files leaked, over %d"%(leaked, Options.max_leaked,))
+  return failures
+
+# START OF MAIN FILE
+proc = None
+try:
+  parser = OptionParser(usage="%prog --OPTIONS [-- DAVITRANS OPTIONS]")
+  parser.add_option("-d", "--duration", dest="duration", action="store", type="int", help="Seconds files are dropped", default=3600)
+  parser.add_option("--drain", dest="drain", action="store", type="int", help="Seconds given to deliver the files waiting once drops stop", default=300)
+  parser.add_option("--warmup", dest="warmup", action="store", type="int", help="Seconds before memory and descriptors are taken as the base for growth", default=60)
+  parser.add_option("--work", dest="work", action="store", help="Work directory, a new temporary one if not given", default=None)
+  parser.add_option("--transport", dest="transport", action="store", type="choice", choices=["scp", "sftp", "ssh", "bundle"], help="Transport of the tx and rx rows: scp, sftp, ssh or bundle", default="ssh")
+  parser.add_option("--checksum", dest="checksum", action="store", help="Checksum of the tx and rx rows, none if not given", default=None)
+  parser.add_option("--direction", dest="direction", action="store", type="choice", choices=["tx", "rx", "both"], help="Direction of dropped files: tx, rx or both", default="both")
+  parser.add_option("--trickle", dest="trickle", action="store", type="float", help="Files a minute dropped steadily", default=30.0)
+  parser.add_option("--burst", dest="burst", action="store", type="int", help="Files dropped at once every --burst-every seconds", default=200)
+  parser.add_option("--burst-every", dest="burst_every", action="store", type="int", help="Seconds between bursts", default=600)
+  parser.add_option("--sizes", dest="sizes", action="store", help="Comma separated size:weight of dropped files, K, M or G suffixes", default="1K:60,64K:30,4M:9,64M:1")
+  parser.add_option("-w", "--wait", dest="wait", action="store", type="int", help="Seconds between davitrans cycles", default=5)
+  parser.add_option("--sample", dest="sample", action="store", type="float", help="Seconds between samples", default=1.0)
+  parser.add_option("--report-every", dest="report_every", action="store", type="int", help="Seconds between progress reports", default=60)
+  parser.add_option("--leak-age", dest="leak_age", action="store", type="int", help="Seconds after which a temporary file counts as leaked while running", default=600)
+  parser.add_option("--max-p50", dest="max_p50", action="store", type="float", help="Maximum median latency in seconds, by direction", default=None)
+  parser.add_option("--max-p95", dest="max_p95", action="store", type="float", help="Maximum p95 latency in seconds, by direction", default=None)
+  parser.add_option("--max-p99", dest="max_p99", action="store", type="float", help="Maximum p99 latency in seconds, by direction", default=None)
+  parser.add_option("--max-latency", dest="max_latency", action="store", type="float", help="Maximum latency in seconds of any file", default=None)
+  parser.add_option("--max-undelivered", dest="max_undelivered", action="store", type="int", help="Files that may be left waiting after draining", default=0)
+  parser.add_option("--max-rss", dest="max_rss", action="store", type="float", help="Maximum resident memory of davitrans in MB", default=None)
+  parser.add_option("--max-rss-growth", dest="max_rss_growth", action="store", type="float", help="Maximum MB resident memory grows after warm-up", default=None)
+  parser.add_option("--max-fds", dest="max_fds", action="store", type="int", help="Maximum open descriptors of davitrans", default=None)
+  parser.add_option("--max-fd-growth", dest="max_fd_growth", action="store", type="int", help="Maximum open descriptors gained after warm-up", default=None)
+  parser.add_option("--max-leaked", dest="max_leaked", action="store", type="int", help="Temporary files that may be leaked", default=0)
+  parser.add_option("--davitrans", dest="davitrans", action="store", help=SUPPRESS_HELP, default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "davitrans.py"))
+  parser.add_option("--DEBUG", dest="DEBUG", action="store_true", help=SUPPRESS_HELP, default=False)
+
+  (Options, Args) = parser.parse_args()
+  Options.PrgName = "soak"
+  Options.lock = threading.Lock()
+  Options.stopping = threading.Event()
+  Options.dropped = {}    # Drop time and size of each waiting file, by (tx|rx, name)
+  Options.latencies = { "tx": [], "rx": [], }
+  Options.rss = []
+  Options.fds = []
+  Options.rss_base = None
+  Options.fds_base = None
+  Options.temps = 0
+  Options.max_temps = 0
+
+  if Options.DEBUG:
+    print(f"---→ Start of execution", file=sys.stderr)
+    print(f"---→ Options=%s"%(Options,), file=sys.stderr)
+    print(f"---→ Args=%s"%(Args,), file=sys.stderr)
+
+  try:
+    parse_sizes(Options.sizes)
+  except (ValueError, IndexError):
+    print(f"%s: Could not parse sizes '%s'"%(Options.PrgName, Options.sizes,), file=sys.stderr)
+    sys.exit(2)
+  work = Options.work or tempfile.mkdtemp(prefix="soak.")
+  try:
+    paths = make_sandbox(work)
+  except (OSError, sqlite3.Error) as e:
+    print(f"%s: Could not prepare '%s' e='%s'"%(Options.PrgName, work, e,), file=sys.stderr)
+    sys.exit(2)
+  full_cmd = [ sys.executable, Options.davitrans, "--ssh-bin", paths["ssh"], "--scp-bin", paths["scp"], "--sftp-bin", paths["sftp"],
+               "--tmp", paths["tmp"], "--seconds", "-w", str(Options.wait), "-C", "soak", ] + Args + [ paths["confdb"], ]
+  if Options.DEBUG:
+    print(f"---→ full_cmd='%s'"%(full_cmd,), file=sys.stderr)
+  print(f"%s %s: soaking for %ds in '%s'"%(datetime.now(), Options.PrgName, Options.duration, work,))
+  Options.latency_file = open(os.path.join(work, "latency.csv"), "w")
+  Options.latency_file.write("time,direction,name,size,latency\n")
+  samples = open(os.path.join(work, "samples.csv"), "w")
+  samples.write("time,rss_mb,fds,temp_files,waiting,tx_delivered,rx_delivered\n")
+  output = open(os.path.join(work, "davitrans.out"), "w")
+  env = dict(os.environ)
+  env.pop("TMPDIR", None)                   # Would override --tmp
+  proc = subprocess.Popen(full_cmd, cwd=work, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT, env=env)
+
+  started = time.time()
+  drops_until = started + Options.duration
+  dropper = threading.Thread(target=arrivals, args=(paths, drops_until,), name="arrivals", daemon=True)
+  dropper.start()
+  reported = started
+  leaked = 0
+  while proc.poll() is None:
+    now = time.time()
+    if now>=drops_until:
+      with Options.lock:
+        waiting = len(Options.dropped)
+      if not dropper.is_alive() and (waiting==0 or now>=drops_until+Options.drain):
+        break
+    collect(paths, now)
+    rss, fds = process_usage(proc.pid)
+    if rss is not None:
+      Options.rss.append(rss)
+      Options.fds.append(fds)
+      if Options.rss_base is None and now-started>=Options.warmup:
+        Options.rss_base, Options.fds_base = rss, fds
+    ages = temp_files(paths, now)
+    Options.temps = len(ages)
+    Options.max_temps = max(Options.max_temps, Options.temps)
+    leaked = max(leaked, len([ an_age for an_age in ages if an_age>Options.leak_age ]))
+    with Options.lock:
+      waiting = len(Options.dropped)
+    samples.write(f"%.3f,%.1f,%s,%d,%d,%d,%d\n"%(now, rss or 0.0, fds if fds is not None else "", Options.temps, waiting,
+      len(Options.latencies["tx"]), len(Options.latencies["rx"]),))
+    samples.flush()
+    Options.latency_file.flush()
+    if now-reported>=Options.report_every:
+      reported = now
+      report()
+    sleep(Options.sample)
+
+  Options.stopping.set()
+  if proc.poll() is None:
+    proc.send_signal(signal.SIGTERM)
+    try:
+      proc.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+      proc.kill()
+      proc.wait()
+  collect(paths, time.time())
+  leaked = max(leaked, len(temp_files(paths, time.time())))
+  Options.temps = leaked
+  report(final=True)
+  failures = check_slos(leaked, proc.returncode)
+  for a_failure in failures:
+    print(f"%s: FAIL %s"%(Options.PrgName, a_failure,))
+  if not failures:
+    print(f"%s: PASS, details in '%s'"%(Options.PrgName, work,))
+  sys.exit(1 if failures else 0)
+except KeyboardInterrupt:
+  if proc is not None and proc.poll() is None:
+    proc.send_signal(signal.SIGTERM)
+    proc.wait()
+  print(f"%s: Process cancelled!"%(Options.PrgName,), file=sys.stderr)
+  sys.exit(2)